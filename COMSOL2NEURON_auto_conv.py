@@ -4,39 +4,528 @@ This file is automatically run by the toolkit. Or, it can be seperately run by u
 It imports and interpolates the .txt voltage profile from COMSOL to transfer resistance in NEURON.
 '''
 
-import pandas as pd
+import os
+import json
+import uuid
+import hashlib
 import numpy as np
+from itertools import product
 from neuron import h
-from scipy.interpolate import LinearNDInterpolator
-
-def convert():
-    # get 3D information about the points evaluated in COMSOL
-    column_names = ['x', 'y', 'z', 'V']
-    df = pd.read_csv('exStimVoltProf.txt', names=column_names, comment='%', delim_whitespace=True)
-    x = np.array(df.x.to_list())
-    y = np.array(df.y.to_list())
-    z = np.array(df.z.to_list())
-    points = np.array([x,y,z]).T
-    V = np.array(df.V.to_list())
-    
-    # get the desired points to interpolate over in NEURON
-    xi = np.array([])
-    yi = np.array([])
-    zi = np.array([])
-    for sec in h.allsec():
-        xi = np.append(xi, sec.x3d(0))
-        yi = np.append(yi, sec.y3d(0))
-        zi = np.append(zi, sec.z3d(0))
+from scipy import sparse
+from scipy.spatial import Delaunay, cKDTree
+from sectionTable import SectionTable
+from runReport import stage
+
+
+"""
+Parse a COMSOL .txt export (header lines start with '%', then whitespace-separated columns x y z V1 ... Vn) in 
+chunks, filling a preallocated float array directly instead of going through an intermediate table.
+Input:
+fname:          string
+                path to the COMSOL export
+chunk_size:     int, optional
+                number of bytes read per chunk; the default is 16 MB
+Returns:        (N_points, N_columns) float array
+"""
+def parseVoltProf(fname, chunk_size=1 << 24):
+    fsize = os.path.getsize(fname)
+    data = None
+    n = 0
+    tail = b''
+    with open(fname, 'rb') as f:
+        while True:
+            block = f.read(chunk_size)
+            if not block and not tail:
+                break
+
+            # only parse complete lines, and carry the rest over to the next chunk
+            if block:
+                block = tail + block
+                cut = block.rfind(b'\n') + 1
+                if cut == 0:
+                    tail = block
+                    continue
+                block, tail = block[:cut], block[cut:]
+            else:
+                block, tail = tail, b''
+
+            # the header is the only place with comments, so most chunks are parsed without splitting lines
+            if b'%' in block:
+                block = b'\n'.join(line for line in block.split(b'\n') if not line.lstrip().startswith(b'%'))
+            if not block.strip():
+                continue
+
+            if data is None:
+                ncols = len(next(line for line in block.split(b'\n') if line.strip()).split())
+                rows_estimate = int(fsize / len(block) * block.count(b'\n') * 1.05) + 1
+                data = np.empty((rows_estimate, ncols))
+
+            values = np.fromstring(block.decode(), sep=' ')
+            rows = values.size // ncols
+            if n + rows > len(data):
+                grown = np.empty((max(2 * len(data), n + rows), ncols))
+                grown[:n] = data[:n]
+                data = grown
+            data[n:n+rows] = values.reshape(rows, ncols)
+            n = n + rows
+
+    if data is None:
+        raise ValueError("No data found in %s" % (fname))
+    return data[:n]
+
+
+"""
+Hash the content of a file in 1 MB blocks.
+"""
+def hashFile(fname):
+    sha = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+"""
+Load a COMSOL .txt export through a sidecar binary cache (<fname>.npy, memory-mapped on load, described by 
+<fname>.json). The cache is valid while the export keeps its size and modification time; if only the modification 
+time changed, the content hash decides. Otherwise the export is parsed again with parseVoltProf().
+Input:
+fname:          string, optional
+                path to the COMSOL export; the default is "exStimVoltProf.txt"
+cache:          bool, optional
+                whether to use the sidecar binary cache; the default is True
+Returns:        (N_points, N_columns) float array
+"""
+def loadVoltProf(fname="exStimVoltProf.txt", cache=True):
+    if not cache:
+        return parseVoltProf(fname)
+
+    npyName = fname + ".npy"
+    metaName = fname + ".json"
+    st = os.stat(fname)
+    if os.path.exists(npyName) and os.path.exists(metaName):
+        with open(metaName) as f:
+            meta = json.load(f)
+        if meta['size'] == st.st_size:
+            if meta['mtime'] != st.st_mtime_ns and meta['sha1'] == hashFile(fname):
+                meta['mtime'] = st.st_mtime_ns
+                with open(metaName, 'w') as f:
+                    json.dump(meta, f)
+            if meta['mtime'] == st.st_mtime_ns:
+                return np.load(npyName, mmap_mode='r')
+
+    data = parseVoltProf(fname)
+    tmp = npyName + ".%s.tmp" % (uuid.uuid4().hex)
+    with open(tmp, 'wb') as f:
+        np.save(f, data)
+    os.replace(tmp, npyName)
+    with open(metaName, 'w') as f:
+        json.dump({'size': st.st_size, 'mtime': st.st_mtime_ns, 'sha1': hashFile(fname)}, f)
+    return data
+
+
+"""
+Hash the shape and content of an array; used to key the interpolation operator cache.
+"""
+def hashArray(a):
+    a = np.ascontiguousarray(a, dtype=np.float64)
+    sha = hashlib.sha1(str(a.shape).encode())
+    sha.update(a.tobytes())
+    return sha.hexdigest()
+
+
+"""
+Build a sparse k-nearest-neighbour interpolation operator of shape (N_segments, N_mesh_points) with a KD-tree. For 
+k = 1 this is nearest-neighbour interpolation, otherwise inverse-distance weighting over the k nearest points.
+Input:
+points:         (N_mesh_points, 3) array of COMSOL mesh points
+coords:         (N_segments, 3) array of NEURON segment coordinates
+k:              int, optional
+                number of nearest mesh points; the default is 8
+power:          int or float, optional
+                power of the inverse-distance weights; the default is 2
+"""
+def buildKDTreeOperator(points, coords, k=8, power=2):
+    k = min(k, len(points))
+    d, idx = cKDTree(points).query(coords, k=k)
+    d = d.reshape(len(coords), k)
+    idx = idx.reshape(len(coords), k)
+
+    # inverse-distance weights; a segment lying exactly on a mesh point takes that point's value
+    with np.errstate(divide='ignore'):
+        weights = 1 / d**power
+    exact = np.isinf(weights).any(axis=1)
+    weights[exact] = np.isinf(weights[exact])
+    weights /= weights.sum(axis=1, keepdims=True)
+
+    rows = np.repeat(np.arange(len(coords)), k)
+    return sparse.csr_matrix((weights.ravel(), (rows, idx.ravel())), shape=(len(coords), len(points)))
+
+
+"""
+Axes of the rectilinear grid formed by the mesh points, e.g. fdmSolver's export at every grid node, in any order.
+Returns:        ((x, y, z) grid coordinates, (Nx, Ny, Nz) array of the row of each grid node in points), or None if
+                the points do not form a complete rectilinear grid
+"""
+def getGridAxes(points):
+    axes = [np.unique(points[:, d]) for d in range(3)]
+    shape = tuple(len(a) for a in axes)
+    if np.prod(shape, dtype=np.float64) != len(points) or min(shape) < 2:
+        return None
+    node = np.full(shape, -1, dtype=np.int64)
+    node[tuple(np.searchsorted(a, points[:, d]) for d, a in enumerate(axes))] = np.arange(len(points))
+    if (node < 0).any():
+        return None
+    return axes, node
+
+
+"""
+Build the sparse trilinear interpolation operator of a rectilinear grid, see getGridAxes(); segments outside the grid
+are flagged, and take the value of the nearest boundary point.
+Output:
+W:              scipy.sparse.csr_matrix of interpolation weights
+outside:        boolean array flagging the segments outside the grid
+"""
+def buildGridOperator(axes, node, coords):
+    cell = []
+    frac = []
+    outside = np.zeros(len(coords), dtype=bool)
+    for d, a in enumerate(axes):
+        i = np.clip(np.searchsorted(a, coords[:, d], side='right') - 1, 0, len(a) - 2)
+        cell.append(i)
+        frac.append(np.clip((coords[:, d] - a[i]) / (a[i+1] - a[i]), 0, 1))
+        outside |= (coords[:, d] < a[0]) | (coords[:, d] > a[-1])
+
+    # the eight corners of each segment's grid cell
+    cols = []
+    weights = []
+    for corner in product((0, 1), repeat=3):
+        cols.append(node[tuple(cell[d] + corner[d] for d in range(3))])
+        weights.append(np.prod([frac[d] if corner[d] else 1 - frac[d] for d in range(3)], axis=0))
+    rows = np.repeat(np.arange(len(coords)), 8)
+    W = sparse.csr_matrix((np.column_stack(weights).ravel(), (rows, np.column_stack(cols).ravel())), \
+            shape=(len(coords), len(node.ravel())))
+    W.eliminate_zeros()
+    return W, outside
+
+
+"""
+Build the sparse interpolation operator W of shape (N_segments, N_mesh_points), such that W @ V interpolates V at 
+the segment coordinates. The weights only depend on the geometry and can be reused for any potential solved on the 
+same mesh.
+With method "linear", W holds the barycentric weights of the Delaunay simplex containing each segment, which is the 
+same interpolation as scipy's LinearNDInterpolator. Mesh points forming a rectilinear grid (fdmSolver's export) are
+interpolated trilinearly on the grid instead, skipping the Delaunay triangulation, which is slow and memory hungry on
+such degenerate point sets. Sections outside the convex hull of the mesh points, for which LinearNDInterpolator 
+returns NaN, fall back to KD-tree inverse-distance weighting.
+With method "nearest" or "idw", the Delaunay triangulation is skipped altogether in favour of a KD-tree, which is 
+much faster and lighter on multi-million-point exports.
+Input:
+points:         (N_mesh_points, 3) array of COMSOL mesh points
+coords:         (N_segments, 3) array of NEURON segment coordinates
+method:         string, optional
+                "linear", "nearest" or "idw"; the default is "linear"
+k:              int, optional
+                number of nearest mesh points used by "idw" and by the out-of-hull fallback; the default is 8
+Output:
+W:              scipy.sparse.csr_matrix of interpolation weights
+outside:        boolean array flagging the segments outside the convex hull of the mesh points (only for "linear")
+"""
+def buildInterpOperator(points, coords, method="linear", k=8):
+    if method == "nearest":
+        return buildKDTreeOperator(points, coords, k=1), np.zeros(len(coords), dtype=bool)
+    if method == "idw":
+        return buildKDTreeOperator(points, coords, k=k), np.zeros(len(coords), dtype=bool)
+    if method != "linear":
+        raise ValueError("Incorrect interpolation method. Method should be linear, nearest or idw. Current method is: %s" % (method))
 
-    # interpolate COMSOL's voltage profile according to NEURON's 3D geometry
-    Vint = LinearNDInterpolator(points, V)
+    grid = getGridAxes(points)
+    if grid is not None:
+        W, outside = buildGridOperator(*grid, coords)
+        W = W.multiply((~outside)[:, None]).tocsr()
+    else:
+        tri = Delaunay(points)
+        simplex = tri.find_simplex(coords)
+        outside = simplex < 0
 
-    # convert voltage profile into transfer resistance rx (unit: ohm)
-    f = open("rx_xtra_interpolated.txt", "w")
+        # barycentric coordinates of each segment within its enclosing simplex
+        T = tri.transform[simplex]
+        b = np.einsum('nij,nj->ni', T[:, :3, :], coords - T[:, 3, :])
+        weights = np.c_[b, 1 - b.sum(axis=1)]
+        weights[outside] = 0
+
+        rows = np.repeat(np.arange(len(coords)), weights.shape[1])
+        cols = tri.simplices[simplex].ravel()
+        W = sparse.csr_matrix((weights.ravel(), (rows, cols)), shape=(len(coords), len(points)))
+
+    # replace the empty rows of out-of-hull segments by inverse-distance weights
+    if outside.any():
+        F = buildKDTreeOperator(points, coords[outside], k=k).tocoo()
+        W = W + sparse.csr_matrix((F.data, (np.flatnonzero(outside)[F.row], F.col)), shape=W.shape)
+    W.eliminate_zeros()
+    return W, outside
+
+
+"""
+Get the interpolation operator from the on-disk cache, or build and cache it. The cache is keyed by the hashes of 
+the COMSOL mesh points and of the NEURON segment coordinates, so re-running C2N on a new solution of the same mesh 
+(e.g. a different electrode current or conductivity) reduces to one sparse matrix-vector product.
+Input:
+points:         (N_mesh_points, 3) array of COMSOL mesh points
+coords:         (N_segments, 3) array of NEURON segment coordinates
+cache_dir:      string or None, optional
+                directory of the operator cache; None disables caching; the default is "c2n_cache"
+method:         string, optional
+                "linear", "nearest" or "idw", see buildInterpOperator(); the default is "linear"
+k:              int, optional
+                number of nearest mesh points for "idw" and the out-of-hull fallback; the default is 8
+"""
+def getInterpOperator(points, coords, cache_dir="c2n_cache", method="linear", k=8):
+    if cache_dir is None:
+        return buildInterpOperator(points, coords, method, k)
+
+    fname = os.path.join(cache_dir, "interp_%s_%s_%s%d.npz" % (hashArray(points)[:16], hashArray(coords)[:16], method, k))
+    if os.path.exists(fname):
+        with np.load(fname) as cached:
+            W = sparse.csr_matrix((cached['data'], cached['indices'], cached['indptr']), shape=tuple(cached['shape']))
+            return W, cached['outside']
+
+    W, outside = buildInterpOperator(points, coords, method, k)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = fname + ".%s.tmp" % (uuid.uuid4().hex)
+    with open(tmp, 'wb') as f:
+        np.savez(f, data=W.data, indices=W.indices, indptr=W.indptr, shape=np.array(W.shape), outside=outside)
+    os.replace(tmp, fname)
+    return W, outside
+
+
+"""
+Name-keyed transfer resistance store. Values are stored per section name (str(sec)), so assigning them does not rely 
+on h.allsec() visiting the sections in the same order as when they were computed: an extra section (e.g. sElec from 
+attachStim.hoc) or a different load order of the nerve builders is handled by name lookup.
+On disk, a store is a pair of files: <fname>.npy holds the float32 or float64 values of all segments back to back and
+is memory-mapped on load, so many worker processes share one copy of the field; <fname>.json holds the section names 
+and the offset of each section's first segment.
+"""
+class RxStore:
+
+    def __init__(self, names, offsets, rx):
+        self.names = list(names)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.rx = rx
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+    """
+    Key an array of per-segment transfer resistance, in the order of table.segCoords, by the table's sections.
+    """
+    @classmethod
+    def fromTable(cls, table, rx):
+        if len(rx) != table.Nseg:
+            raise ValueError("Got %d transfer resistance values for %d segments" % (len(rx), table.Nseg))
+        return cls(table.names, table.offsets, np.asarray(rx))
+
+    """
+    Transfer resistance of each segment of the named section, or None if the section is not in the store.
+    """
+    def lookup(self, name):
+        i = self.index.get(name)
+        if i is None:
+            return None
+        return self.rx[self.offsets[i]:self.offsets[i+1]]
+
+    """
+    Per-segment transfer resistance in the order of the current h.allsec(); sections missing from the store get 0.
+    """
+    def forModel(self):
+        rx = []
+        missing = []
+        for sec in h.allsec():
+            secrx = self.lookup(str(sec))
+            if secrx is None:
+                missing.append(str(sec))
+                secrx = np.zeros(sec.nseg)
+            elif len(secrx) != sec.nseg:
+                raise ValueError("Section %s has %d segments but %d stored values" % (str(sec), sec.nseg, len(secrx)))
+            rx.append(secrx)
+        if missing:
+            print("%d section(s) not in the rx store, rx set to 0: %s\n" % (len(missing), ', '.join(missing[:5])))
+        return np.concatenate(rx) if rx else np.zeros(0)
+
+    def save(self, fname="rx_xtra_interpolated", dtype=np.float64):
+        with open(fname + ".npy.tmp", 'wb') as f:
+            np.save(f, np.asarray(self.rx, dtype=dtype))
+        os.replace(fname + ".npy.tmp", fname + ".npy")
+        with open(fname + ".json", 'w') as f:
+            json.dump({'names': self.names, 'offsets': self.offsets.tolist()}, f)
+
+    @classmethod
+    def load(cls, fname="rx_xtra_interpolated", mmap=True):
+        with open(fname + ".json") as f:
+            index = json.load(f)
+        return cls(index['names'], index['offsets'], np.load(fname + ".npy", mmap_mode='r' if mmap else None))
+
+
+"""
+Assign the transfer resistance to every NEURON segment and link xtra with extracellular, as setrx.hoc does, but 
+directly from an array instead of reading rx_xtra_interpolated.txt back value by value.
+Input:
+rx:             array_like or RxStore
+                transfer resistance (unit: ohm) of each segment, in the order of h.allsec(), or a name-keyed 
+                RxStore
+"""
+def setrx(rx):
+    if isinstance(rx, RxStore):
+        rx = rx.forModel()
+    rx = np.asarray(rx, dtype=float) / 1e6
+    Nseg = sum(sec.nseg for sec in h.allsec())
+    if len(rx) != Nseg:
+        raise ValueError("Got %d transfer resistance values for %d segments" % (len(rx), Nseg))
+
+    i = 0
     for sec in h.allsec():
-        rx_xtra = Vint(np.array([sec.x3d(0), sec.y3d(0), sec.z3d(0)])) / 1e-6
-        f.write("%f\n"%(rx_xtra))
-    f.close()
+        sec.insert('extracellular')
+        sec.insert('xtra')
+        for seg in sec:
+            seg.xtra.rx = rx[i]
+            h.setpointer(seg._ref_i_membrane, 'im', seg.xtra)
+            h.setpointer(seg._ref_e_extracellular, 'ex', seg.xtra)
+            i = i + 1
+
+
+"""
+Write the per-segment transfer resistance as <rx_file>.txt, one value per line as read by setrx.hoc and loadrx(), and
+as the name-keyed RxStore <rx_file>.npy/.json.
+Input:
+table:          SectionTable snapshot the transfer resistance was computed for
+rx:             (N_segments,) array of transfer resistance (unit: ohm), in the order of table.segCoords
+rx_file:        string, optional
+                base name of the transfer resistance files; the default is "rx_xtra_interpolated"
+rx_dtype:       numpy dtype, optional
+                float precision of the RxStore; the default is np.float64
+"""
+def saverx(table, rx, rx_file="rx_xtra_interpolated", rx_dtype=np.float64):
+    np.savetxt(rx_file + ".txt", rx, fmt="%f")
+    RxStore.fromTable(table, rx).save(rx_file, rx_dtype)
+
+
+"""
+Read a transfer resistance file written by convert() and assign it with setrx(). A .npy file is read as a 
+name-keyed RxStore, anything else as the plain text list of values.
+Input:
+fname:          string, optional
+                path to the transfer resistance file; the default is "rx_xtra_interpolated.txt"
+"""
+def loadrx(fname="rx_xtra_interpolated.txt"):
+    if fname.endswith(".npy"):
+        setrx(RxStore.load(fname[:-len(".npy")]))
+    else:
+        setrx(np.loadtxt(fname, ndmin=1))
+
+
+"""
+Superpose the per-contact transfer resistances into the transfer resistance of one contact weighting. By linearity, 
+driving contact i with weights[i] times the stimulus current is(t) gives rx = rx_matrix @ weights.
+Input:
+rx_matrix:      (N_segments, N_contacts) array of transfer resistances, one column per contact at unit current
+weights:        array_like
+                [w1, w2, ..., wn] current weight of each contact, e.g. [1, -1/6, -1/6, -1/6, -1/6, -1/6, -1/6] for a 
+                hexapolar TIME whose six return contacts share the stimulating current
+"""
+def superpose(rx_matrix, weights):
+    return np.asarray(rx_matrix) @ np.asarray(weights, dtype=float)
+
+
+"""
+Master function.
+A COMSOL export with more than one potential column (x y z V1 V2 ... Vn, one column per contact solved at unit 
+current) is interpolated in the same pass into an (N_segments, N_contacts) rx matrix, written to <rx_file>_matrix.txt. 
+Any contact weighting can then be formed by superpose() without another COMSOL run.
+Input:
+cache_dir:      string or None, optional
+                directory of the interpolation operator cache; None disables caching; the default is "c2n_cache"
+method:         string, optional
+                interpolation method: "linear" (Delaunay, with KD-tree fallback outside the convex hull), "nearest" 
+                (KD-tree nearest neighbour) or "idw" (KD-tree inverse-distance weighting); the default is "linear"
+k:              int, optional
+                number of nearest mesh points for "idw" and the out-of-hull fallback; the default is 8
+contact_weights: array_like, optional
+                current weight of each contact for a multi-contact export, see superpose(); the default is None, 
+                which only writes the rx matrix for multi-contact exports and leaves the NEURON model unchanged
+volt_file:      string, optional
+                path to the COMSOL voltage profile; the default is "exStimVoltProf.txt"
+volt_cache:     bool, optional
+                whether to keep a binary copy of the voltage profile next to it for fast re-loading, see 
+                loadVoltProf(); the default is True
+rx_dtype:       numpy dtype, optional
+                float precision of the name-keyed rx store <rx_file>.npy, see RxStore; the default is np.float64
+rx_file:        string, optional
+                base name of the transfer resistance files: <rx_file>.txt, the RxStore <rx_file>.npy/.json and, for a
+                multi-contact export, <rx_file>_matrix.txt; the default is "rx_xtra_interpolated"
+table:          SectionTable, optional
+                snapshot of the NEURON model to interpolate over; the default is None, which takes a snapshot of the 
+                currently loaded NEURON model
+assign:         bool, optional
+                whether to assign the transfer resistance to the loaded NEURON model with setrx(); set to False when 
+                converting a saved SectionTable in a process without the NEURON model; the default is True
+report:         RunReport, optional
+                records the time spent parsing, triangulating, interpolating, writing and assigning; the default is 
+                None
+Returns:        the transfer resistance, an (N_segments,) array, or an (N_segments, N_contacts) array for a 
+                multi-contact export
+"""
+def convert(cache_dir="c2n_cache", method="linear", k=8, contact_weights=None, volt_file="exStimVoltProf.txt", \
+                                volt_cache=True, rx_dtype=np.float64, table=None, assign=True, rx_file="rx_xtra_interpolated", \
+                                report=None):
+    # get 3D information about the points evaluated in COMSOL; every column after x, y, z is one contact's potential
+    with stage(report, "c2n/parse"):
+        data = loadVoltProf(volt_file, volt_cache)
+    points = np.ascontiguousarray(data[:, :3])
+    V = np.ascontiguousarray(data[:, 3:])
+    if V.shape[1] == 1:
+        V = V[:, 0]
+    
+    # get the desired points to interpolate over in NEURON: the centre of every segment
+    if table is None:
+        table = SectionTable.capture()
+    coords = table.segCoords
+
+    # a voltage profile exported at the NEURON segment centres (N2C's export_mode="points") is used as is; otherwise
+    # interpolate COMSOL's voltage profile according to NEURON's 3D geometry with the (cached) sparse operator
+    if points.shape == coords.shape and np.allclose(points, coords, rtol=0, atol=1e-6):
+        Vint = V
+        # mphinterp returns NaN at segment centres outside COMSOL's geometry: take them from the finite ones instead
+        bad = ~np.isfinite(V.reshape(len(V), -1)).all(axis=1)
+        if bad.all():
+            raise ValueError("No finite voltage in %s" % (volt_file))
+        if bad.any():
+            print("%d segment(s) outside COMSOL's geometry, interpolated by inverse-distance weighting\n" % (bad.sum()))
+            with stage(report, "c2n/interpolate"):
+                W, _ = getInterpOperator(points[~bad], coords[bad], cache_dir, "idw", k)
+                Vint = V.copy()
+                Vint[bad] = W @ V[~bad]
+    else:
+        with stage(report, "c2n/triangulate", points=len(points)):
+            W, outside = getInterpOperator(points, coords, cache_dir, method, k)
+        if outside.any():
+            print("%d segment(s) outside COMSOL's convex hull, interpolated by inverse-distance weighting\n" % (outside.sum()))
+        with stage(report, "c2n/interpolate"):
+            Vint = W @ V
+
+    # convert voltage profile into transfer resistance rx (unit: ohm), and write it in bulk
+    rx_xtra = Vint / 1e-6
+    if rx_xtra.ndim == 2:
+        np.savetxt(rx_file + "_matrix.txt", rx_xtra, fmt="%f")
+        if contact_weights is None:
+            print("%d contacts exported, rx matrix written to %s_matrix.txt\n" % (rx_xtra.shape[1], rx_file))
+            return rx_xtra
+        rx = superpose(rx_xtra, contact_weights)
+    else:
+        rx = rx_xtra
+    with stage(report, "c2n/write"):
+        saverx(table, rx, rx_file, rx_dtype)
 
-    # assign the transfer resistance to each NEURON section
-    h.load_file("setrx.hoc")
\ No newline at end of file
+    # assign the transfer resistance to each NEURON segment
+    if assign:
+        with stage(report, "setrx"):
+            setrx(rx)
+    return rx_xtra
@@ -21,8 +21,11 @@ Two assumptions / simplifications are made:
 (2) the nerve, fascicles, fibres are all oriented towards x-axis. 
 '''
 
-from neuron import h
+import os
+import numpy as np
 from datetime import datetime
+from itertools import product
+from sectionTable import SectionTable
 
 
 version = "1.0"
@@ -30,8 +33,12 @@ version = "1.0"
 
 """
 Defines geometry entity, electric current entity, units, and mphselect margins.
+Input:
+start_server:   bool, optional
+                whether the script starts the COMSOL server and links it with MATLAB; set to False when the script is
+                run by a ComsolSession, which keeps both running across scripts; the default is True
 """
-def writePreamble(fout, path2server, path2mph):
+def writePreamble(fout, path2server, path2mph, start_server=True):
 
     # write function header
     txt = \
@@ -40,12 +47,10 @@ def writePreamble(fout, path2server, path2mph):
     "function model = NEURON2COMSOL_auto_conv\n"
     fout.write(txt % (datetime.now().strftime("%d/%m/%Y %H:%M:%S"), version))
 
-    # write preamble
-    txt = \
+    # start COMSOL server and link it with MATLAB, unless a session keeps them running
+    if start_server:
+        server = \
         r"""
-    clc; clear;
-    tic;
-
     %% start COMSOL server
     cd '%s'
     open('comsolmphserver.exe');
@@ -53,15 +58,35 @@ def writePreamble(fout, path2server, path2mph):
     %% link COMSOL with MATLAB through LiveLink
     cd '%s'
     mphstart(2036);
+        """ % (path2server, path2mph)
+        reuse = ""
+    else:
+        server = \
+        r"""
+    % COMSOL server and LiveLink are kept running by a ComsolSession
+        """
+        reuse = \
+        r"""
+    % drop the model left on the server by a previous script
+    try
+        ModelUtil.remove('Model');
+    end
+        """
 
+    # write preamble
+    txt = \
+        r"""
+    clc; clear;
+    tic;
+    %s
     %% change back to current foler
     if(~isdeployed)
-        cd(fileparts(matlab.desktop.editor.getActiveFilename));
+        cd(fileparts(mfilename('fullpath')));
     end
 
     import com.comsol.model.*
     import com.comsol.model.util.*
-
+    %s
     model = ModelUtil.create('Model');
     model.label('NEURON2COMSOL_auto_conv.mph');
     model.component.create('comp1', true);
@@ -79,8 +104,40 @@ def writePreamble(fout, path2server, path2mph):
 
     %% set the margin for the function mphselectbox()
     delta = 0.05;
+
+    %% time the stages, see logTiming(); written to NEURON2COMSOL_timings.json
+    timings = struct('startup', toc);
+    stage_t = toc;
         """ 
-    fout.write(txt % (path2server, path2mph))
+    fout.write(txt % (server, reuse))
+
+
+"""
+Log the time since the previous logged stage under a name in the MATLAB struct timings; a stage logged several times
+(e.g. once per electrode configuration) keeps every value. After meshing, also log the number of mesh elements, i.e.
+of tetrahedra.
+Input:
+name:           string
+                one of "geometry", "entities", "materials", "mesh", "study" and "export"
+"""
+def logTiming(fout, name):
+
+    txt = \
+        r"""
+    if ~isfield(timings, '%s'), timings.%s = []; end
+    timings.%s(end+1) = toc - stage_t;
+    stage_t = toc;
+        """
+    fout.write(txt % (name, name, name))
+    if name == "mesh":
+        txt = \
+        r"""
+    mesh_stats = mphmeshstats(model);
+    if ~isfield(timings, 'mesh_elements'), timings.mesh_elements = []; end
+    timings.mesh_elements(end+1) = sum(mesh_stats.numelem(strcmp(mesh_stats.types, 'tet')));
+    stage_t = toc;
+        """
+        fout.write(txt)
 
 
 """
@@ -225,6 +282,7 @@ def buildMonopolarElectrode(fout, substrate_3D, substrate_W, substrate_L, substr
     model.component('comp1').material.create('mate1');
     model.component('comp1').material('mate1').materialModel('def').set('electricconductivity', {'1e7[S/m]'});    
     model.component('comp1').material('mate1').selection().set(e_domain);
+    electrode_domains = [substrate_domain, e_domain];
 
     %% add current source to the electrode using floating potential
     model.component('comp1').physics('ec').create('fpe1', 'FloatingPotential', 2);
@@ -410,6 +468,7 @@ def buildHexapolarElectrode(fout, substrate_3D, substrate_W, substrate_L, substr
     model.component('comp1').material.create('mate1');
     model.component('comp1').material('mate1').materialModel('def').set('electricconductivity', {'1e7[S/m]'});    
     model.component('comp1').material('mate1').selection().set([stim_e_domain, rtn_e1_domain, rtn_e2_domain, rtn_e3_domain, rtn_e4_domain, rtn_e5_domain, rtn_e6_domain]);
+    electrode_domains = [substrate_domain, stim_e_domain, rtn_e1_domain, rtn_e2_domain, rtn_e3_domain, rtn_e4_domain, rtn_e5_domain, rtn_e6_domain];
 
     %% add stimulating current source to the stimulating electrode using floating potential
     stim_e_bdrny = mphselectbox(model, 'geom1', [stim_electrode_x-electrode_r-delta stim_electrode_y+electrode_r+delta stim_electrode_z-delta; ... 
@@ -466,6 +525,7 @@ def buildFascicle(fout, fasc_3D, fasc_R, fasc_L, fasc_G=0.0517):
     % build the fascicle wrapping arouond the fibre(s)
     fprintf('building fascicles ...\n');
     fasc_domains = [];
+    fasc_domain_each = {};
         """
     fout.write(txt)
 
@@ -488,6 +548,7 @@ def buildFascicle(fout, fasc_3D, fasc_R, fasc_L, fasc_G=0.0517):
     fasc_domain = mphselectbox(model, 'geom1', [xpos-delta ypos+r+delta zpos-r-delta; xpos+h+delta ...
         ypos-r-delta zpos+r+delta]', 'domain', 'include', 'any');
     fasc_domains = [fasc_domains, fasc_domain];
+    fasc_domain_each{end+1} = fasc_domain;
     model.component('comp1').material.create(matName);
     model.component('comp1').material(matName).materialModel('def').set('electricconductivity', {'%g[S/m]'});   
     model.component('comp1').material(matName).selection().set(fasc_domain);
@@ -495,6 +556,82 @@ def buildFascicle(fout, fasc_3D, fasc_R, fasc_L, fasc_G=0.0517):
         fout.write(txt % (i, fasc_L, fasc_R[i], fasc_3D[i][0], fasc_3D[i][1], fasc_3D[i][2], fasc_G))
 
 
+"""
+Describe the NEURON fibres as COMSOL cylinders, each as a tuple (name, height, radius, x, y, z, conductivity).
+Input:
+table:          SectionTable snapshot of the NEURON model
+fibre_merge:    string, optional
+                "none" - one cylinder per NEURON section;
+                "run" - consecutive collinear sections of a fibre with the same diameter and conductivity are merged 
+                into one cylinder;
+                "fibre" - consecutive collinear sections of a fibre are merged into one cylinder whatever their
+                diameter and conductivity; its radius preserves the fibre volume, and its conductivity 
+                g = sum(L_i) / (A * sum(L_i / (g_i * A_i))), with A its cross-section and A_i the sections', preserves
+                the axial resistance; the default is "none"
+"""
+def getFibreCylinders(table, fibre_merge="none"):
+    names = np.array(table.comsolNames(), dtype=str)
+    L = table.L
+    radius = table.diam / 2
+    g = 100 / table.Ra
+    x, y, z = table.start.T
+
+    if fibre_merge == "none":
+        return list(zip(names, L, radius, x, y, z, g))
+    if fibre_merge not in ("run", "fibre"):
+        raise ValueError("Incorrect fibre merge mode. Mode should be none, run or fibre. Current mode is: %s" % (fibre_merge))
+    if table.Nsec == 0:
+        return []
+
+    # sort the sections by fibre, then along x-axis, since sections are visited in creation order
+    _, fibre = np.unique(table.fibres, return_inverse=True)
+    order = np.lexsort((x, fibre))
+    names, fibre, L, radius, g, x, y, z = (a[order] for a in (names, fibre, L, radius, g, x, y, z))
+
+    # merge runs of contiguous collinear sections
+    tol = 1e-3
+    joined = (fibre[1:] == fibre[:-1]) & (np.abs(x[1:] - x[:-1] - L[:-1]) < tol) \
+                & (np.abs(y[1:] - y[:-1]) < tol) & (np.abs(z[1:] - z[:-1]) < tol)
+    if fibre_merge == "run":
+        joined &= (radius[1:] == radius[:-1]) & (g[1:] == g[:-1])
+    first = np.flatnonzero(np.r_[True, ~joined])
+    runL = np.add.reduceat(L, first)
+    runRadius = np.sqrt(np.add.reduceat(L * radius**2, first) / runL)
+    runG = runL / (runRadius**2 * np.add.reduceat(L / (g * radius**2), first))
+    return list(zip(names[first], runL, runRadius, x[first], y[first], z[first], runG))
+
+
+"""
+Write the fibre cylinders to a compact table (one line per cylinder: name, height, radius, x, y, z, conductivity), 
+which the generated MATLAB script loops over instead of carrying one unrolled block of code per cylinder.
+Input:
+cyls:           list of fibre cylinders from getFibreCylinders()
+fname:          string, optional
+                path to the fibre table; the default is "NEURON2COMSOL_fibres.txt"
+"""
+def writeFibreTable(cyls, fname="NEURON2COMSOL_fibres.txt"):
+    with open(fname, 'w') as f:
+        f.writelines("%s %.10g %.10g %.10g %.10g %.10g %.10g\n" % cyl for cyl in cyls)
+
+
+"""
+Read the fibre table written by writeFibreTable() into MATLAB.
+"""
+def readFibreTable(fout, fname="NEURON2COMSOL_fibres.txt"):
+
+    txt = \
+        r"""
+    %% read fibre table
+    fid = fopen(append(fileparts(mfilename('fullpath')), '/%s'));
+    fibres = textscan(fid, '%%s %%f %%f %%f %%f %%f %%f');
+    fclose(fid);
+    [fibreName, fibreH, fibreR, fibreX, fibreY, fibreZ, fibreG] = fibres{:};
+    Nfibre = numel(fibreName);
+    progressStep = max(1, floor(Nfibre/100));
+        """
+    fout.write(txt % (fname))
+
+
 """
 Build the COMSOL fibre geometries by copying fibres' geometrical information from NEURON's .hoc section.
 """
@@ -502,46 +639,46 @@ def buildFibreGeom(fout):
 
     txt = \
         r"""
-    % build fibre(s)
+    % build fibre(s); each cylinder creates its own domain selection, and contributes to the selection of all fibres
     fprintf('building fibre geometry: %3d%%\n', 0);
+    model.component('comp1').geom('geom1').selection.create('csel_fibres', 'CumulativeSelection');
+    for i = 1:Nfibre
+        cylName = fibreName{i};
+        model.component('comp1').geom('geom1').create(cylName, 'Cylinder');
+        model.component('comp1').geom('geom1').feature(cylName).set('axis', [1 0 0]);
+        model.component('comp1').geom('geom1').feature(cylName).set('h', fibreH(i));
+        model.component('comp1').geom('geom1').feature(cylName).set('r', fibreR(i));
+        model.component('comp1').geom('geom1').feature(cylName).set('pos', [fibreX(i) fibreY(i) fibreZ(i)]);
+        model.component('comp1').geom('geom1').feature(cylName).set('selresult', true);
+        model.component('comp1').geom('geom1').feature(cylName).set('selresultshow', 'dom');
+        model.component('comp1').geom('geom1').feature(cylName).set('contributeto', 'csel_fibres');
+        if mod(i, progressStep) == 0 || i == Nfibre
+            fprintf('\b\b\b\b%3.0f%%', 100*i/Nfibre);
+        end
+    end
+    fprintf('\n');
         """
     fout.write(txt)
 
-    # iterate through NEURON's .hoc sections, and describe each section using COMSOL's language
-    Nsec = 0
-    for sec in h.allsec():
-        Nsec = Nsec + 1
-
-    secCounter = 0
-    for sec in h.allsec():
-        secCounter = secCounter + 1
-        name = ''.join(e for e in str(sec) if e.isalnum())
-        height = sec.L
-        radius = sec.diam / 2
-        x = sec.x3d(0)
-        y = sec.y3d(0)
-        z = sec.z3d(0)
-        txt = \
-        r"""
-    cylName = "%s";
-    model.component('comp1').geom('geom1').create(cylName, 'Cylinder');
-    model.component('comp1').geom('geom1').feature(cylName).set('axis', [1 0 0]);
-    model.component('comp1').geom('geom1').feature(cylName).set('h', %g);
-    model.component('comp1').geom('geom1').feature(cylName).set('r', %g);
-    model.component('comp1').geom('geom1').feature(cylName).set('pos', [%g %g %g]);
-    fprintf('\b\b\b\b%%3.0f%%%%', %g); pause(0.1);
-        """
-        fout.write(txt % (name, height, radius, x, y, z, 100*secCounter/Nsec))
+
+"""
+Build (finalise) the geometry, so that the time it takes is logged as the geometry stage.
+"""
+def runGeometry(fout):
 
     txt = \
         r"""
-    fprintf('\n');
+    % build geometry
+    model.component('comp1').geom('geom1').run;
         """
     fout.write(txt)
 
 
 """
 Obtain fibres' entity number which uniquely refer to a fibre domain, and store them in a dictionary.
+The entity numbers are read from the selection each fibre cylinder creates when the geometry is built by 
+runGeometry(), instead of searching every domain of the geometry with mphselectbox() once per fibre, so the lookup 
+scales linearly.
 """
 def getFibreEntityNum(fout):
 
@@ -550,108 +687,136 @@ def getFibreEntityNum(fout):
     % get entity number
     entityNum = containers.Map; 
     fprintf('getting fibre entity number: %3d%%\n', 0);
-        """
-    fout.write(txt)
-
-    # store fibre's entity number in a dictionary
-    Nsec = 0
-    for sec in h.allsec():
-        Nsec = Nsec + 1
-
-    secCounter = 0
-    for sec in h.allsec():
-        secCounter = secCounter + 1
-        name = ''.join(e for e in str(sec) if e.isalnum())
-        height = sec.L
-        radius = sec.diam / 2
-        x = sec.x3d(0)
-        y = sec.y3d(0)
-        z = sec.z3d(0)
-        txt = \
-        r"""
-    h = %g;
-    r = %g;
-    xpos = %g;
-    ypos = %g;
-    zpos = %g;
-    entityNum('%s') = mphselectbox(model, 'geom1', [xpos-delta ypos+r+delta zpos-r-delta; xpos+h+delta ...
-            ypos-r-delta zpos+r+delta]', 'domain', 'include', 'any');
-    fprintf('\b\b\b\b%%3.0f%%%%', %g); pause(0.1);
-        """
-        fout.write(txt % (height, radius, x, y, z, name, 100*secCounter/Nsec))
+    for i = 1:Nfibre
+        entityNum(fibreName{i}) = model.component('comp1').selection(['geom1_' fibreName{i} '_dom']).entities(3);
+        if mod(i, progressStep) == 0 || i == Nfibre
+            fprintf('\b\b\b\b%3.0f%%', 100*i/Nfibre);
+        end
+    end
 
-    # create an array to store all geom domains
-    txt = \
-        r"""
+    % create an array to store all geom domains
     fprintf('\n');
-    fibre_domains = cell2mat(entityNum.values());
+    fibre_domains = model.component('comp1').selection('geom1_csel_fibres_dom').entities(3);
         """
     fout.write(txt)
 
 
 """
-Assign conductivity to each fibre geometry.
+Assign conductivity to the fibre geometries, with one material per distinct conductivity value whose selection is
+the union of the domains of all fibres with that conductivity.
 """
 def assignFibreConductivity(fout):
 
-    # write preamble
     txt = \
         r"""
     % assign conductivity 
-    fprintf('assigning fibre conductivity: %3d%%\n', 0);
+    [fibreGs, ~, fibreGid] = unique(fibreG);
+    fprintf('assigning fibre conductivity: %d materials\n', numel(fibreGs));
+    for j = 1:numel(fibreGs)
+        matName = sprintf('matfibre%d', j);
+        doms = values(entityNum, fibreName(fibreGid == j));
+        doms = unique(cell2mat(cellfun(@(d) d(:)', doms(:)', 'UniformOutput', false)));
+        model.component('comp1').material.create(matName);
+        model.component('comp1').material(matName).materialModel('def').set('electricconductivity', ...
+            {sprintf('%g[S/m]', fibreGs(j))});
+        model.component('comp1').material(matName).selection().set(doms);
+    end
+    model.save(append(fileparts(mfilename('fullpath')), '/NEURON2COMSOL_auto_conv.mph'));
         """
     fout.write(txt)
 
-    # assign conductivity
-    Nsec = 0
-    for sec in h.allsec():
-        Nsec = Nsec + 1
 
-    secCounter = 0
-    for sec in h.allsec():
-        secCounter = secCounter + 1
-        name = ''.join(e for e in str(sec) if e.isalnum())
-        g = 100 / sec.Ra
-        txt = \
-        r"""
-    secName = '%s';
-    matName = append('mat', secName);
-    model.component('comp1').material.create(matName);
-    model.component('comp1').material(matName).materialModel('def').set('electricconductivity', {'%g[S/m]'});
-    model.component('comp1').material(matName).selection().set(entityNum(secName));
-    fprintf('\b\b\b\b%%3.0f%%%%', %g); pause(0.1);
-        """
-        fout.write(txt % (name, g, 100*secCounter/Nsec))
-
-    txt = \
-        r"""
-    fprintf('\n');
-    model.save(append(fileparts(matlab.desktop.editor.getActiveFilename), '/NEURON2COMSOL_auto_conv.mph'));
-        """
-    fout.write(txt)
+"""
+Find the fascicles whose surface lies within a given distance of the TIME electrode. The electrode sits at the centre
+of the substrate, which COMSOL rotates about the x-axis through the origin.
+Input:
+fasc_3D:        2D array_like
+                [[x1, y1, z1], [x2, y2, z2], ..., [xn, yn, zn]] position of the centre of each fascicle's starting face
+fasc_R:         array_like
+                [R1, R2, ..., Rn] radius of each fascicle
+substrate_3D:   array_like
+                [x, y, z] position of the centre of the TIME substrate
+rotate_deg:     int or float
+                rotation of TIME along x-axis in degree
+refine_dist:    int or float
+                distance from the electrode within which fascicles are selected
+Returns:        list of fascicle indices
+"""
+def getFasciclesNearElectrode(fasc_3D, fasc_R, substrate_3D, rotate_deg, refine_dist):
+    if len(fasc_R) == 0:
+        return []
+    theta = np.deg2rad(rotate_deg)
+    e_y = substrate_3D[1]*np.cos(theta) - substrate_3D[2]*np.sin(theta)
+    e_z = substrate_3D[1]*np.sin(theta) + substrate_3D[2]*np.cos(theta)
+    fasc_3D = np.asarray(fasc_3D, dtype=float).reshape(-1, 3)
+    dist = np.hypot(fasc_3D[:, 1] - e_y, fasc_3D[:, 2] - e_z) - np.asarray(fasc_R, dtype=float)
+    return [int(i) for i in np.flatnonzero(dist < refine_dist)]
 
 
 """
 Mesh the COMSOL model with free tetrahedral elements.
+Optionally, the TIME electrode and its substrate, and the fascicles near the electrode, are meshed with their own, 
+finer element size, while mesh_size then sets the coarser size of the simulation box and of the distant nerve. 
+Element size grows gradually from the refined regions.
 Input:
 mesh_size:      int, optional
                 mesh resolution: 1 - extremely fine, 2 - extra fine, 3 - finer, 4 - fine, 
                 5 - normal, 6 - coarse, 7 - coarser, 8 - extra coarse, 9 - extremely coarse;
                 the default is 3 - finer
+e_mesh_size:    int, optional
+                mesh resolution of the TIME electrode and substrate, on the same scale as mesh_size; the default is 
+                None, which applies mesh_size everywhere
+fasc_mesh_size: int, optional
+                mesh resolution of the fascicles listed in near_fasc, on the same scale as mesh_size; the default is 
+                None, which applies mesh_size to them
+near_fasc:      list, optional
+                indices of the fascicles to refine, e.g. from getFasciclesNearElectrode(); the default is none
 """
-def mesh(fout, mesh_size=3):
+def mesh(fout, mesh_size=3, e_mesh_size=None, fasc_mesh_size=None, near_fasc=()):
 
+    # create the mesh sequence, unless it already exists from a previous electrode configuration
     txt = \
         r"""
     %% fine meshing
     fprintf('meshing ...\n');
-    model.component('comp1').mesh.create('mesh1');
+    if ~any(strcmp(cell(model.component('comp1').mesh.tags()), 'mesh1'))
+        model.component('comp1').mesh.create('mesh1');
+        %s
+        %s
+        model.component('comp1').mesh('mesh1').create('ftet1', 'FreeTet');
+    end
     model.component('comp1').mesh('mesh1').feature('size').set('hauto', %g);
-    model.component('comp1').mesh('mesh1').create('ftet1', 'FreeTet');
+        """
+    fout.write(txt % ("model.component('comp1').mesh('mesh1').create('size_e', 'Size');" if e_mesh_size is not None else "", \
+            "model.component('comp1').mesh('mesh1').create('size_fasc', 'Size');" if fasc_mesh_size is not None else "", \
+            mesh_size))
+
+    # refine the electrode region
+    if e_mesh_size is not None:
+        txt = \
+            r"""
+    model.component('comp1').mesh('mesh1').feature('size_e').selection.geom('geom1', 3);
+    model.component('comp1').mesh('mesh1').feature('size_e').selection.set(electrode_domains);
+    model.component('comp1').mesh('mesh1').feature('size_e').set('hauto', %g);
+            """
+        fout.write(txt % (e_mesh_size))
+
+    # refine the fascicles near the electrode
+    if fasc_mesh_size is not None:
+        txt = \
+            r"""
+    model.component('comp1').mesh('mesh1').feature('size_fasc').selection.geom('geom1', 3);
+    model.component('comp1').mesh('mesh1').feature('size_fasc').selection.set([fasc_domain_each{[%s]}]);
+    model.component('comp1').mesh('mesh1').feature('size_fasc').set('hauto', %g);
+            """
+        fout.write(txt % (' '.join(str(i+1) for i in near_fasc), fasc_mesh_size))
+
+    txt = \
+        r"""
     model.component('comp1').mesh('mesh1').run();
-    model.save(append(fileparts(matlab.desktop.editor.getActiveFilename), '/NEURON2COMSOL_auto_conv.mph'));
+    model.save(append(fileparts(mfilename('fullpath')), '/NEURON2COMSOL_auto_conv.mph'));
         """
-    fout.write(txt % (mesh_size))
+    fout.write(txt)
 
 
 """
@@ -663,37 +828,124 @@ def study(fout):
         r"""
     % study
     fprintf('studying ...\n');
-    model.study.create('std');
-    model.study('std').feature.create('stat', 'Stationary');
+    if ~any(strcmp(cell(model.study.tags()), 'std'))
+        model.study.create('std');
+        model.study('std').feature.create('stat', 'Stationary');
+    end
     model.study('std').run;
     data = mpheval(model,{'V'},'selection',1);
-    model.save(append(fileparts(matlab.desktop.editor.getActiveFilename), '/NEURON2COMSOL_auto_conv.mph'));
+    model.save(append(fileparts(mfilename('fullpath')), '/NEURON2COMSOL_auto_conv.mph'));
         """
     fout.write(txt)
 
 
 """
-Export the voltage profile into a .txt file, named exStimVoltProf.txt.
+Export the voltage profile into a .txt file, named exStimVoltProf.txt by default.
+Input:
+fname:          string, optional
+                name of the exported file; the default is "exStimVoltProf.txt"
 """
-def export(fout):
+def export(fout, fname="exStimVoltProf.txt"):
 
     txt = \
         r"""
-    % export voltage profile
+    %% export voltage profile
     fprintf('exporting data ...\n');
-    model.result.numerical.create('pev1', 'EvalPoint');
-    model.result.numerical('pev1').selection.all;
-    model.result.export.create('data1', 'Data');
-    model.result.export('data1').set('filename', append(fileparts(matlab.desktop.editor.getActiveFilename), ...
-        '/exStimVoltProf.txt'));
-    model.result.export('data1').setIndex('expr', 'V', 0);
+    if ~any(strcmp(cell(model.result.export.tags()), 'data1'))
+        model.result.numerical.create('pev1', 'EvalPoint');
+        model.result.numerical('pev1').selection.all;
+        model.result.export.create('data1', 'Data');
+        model.result.export('data1').setIndex('expr', 'V', 0);
+    end
+    model.result.export('data1').set('filename', append(fileparts(mfilename('fullpath')), ...
+        '/%s'));
     model.result.export('data1').run;        
         """
-    fout.write(txt)
+    fout.write(txt % (fname))
 
 
 """
-Save the COMSOL model as .mph file, named NEURON2COMSOL_auto_conv.mph.
+Export the voltage profile evaluated only at the NEURON sample points (the segment centres written by 
+writeSamplePoints()) into a .txt file in the same x y z V format, instead of at every mesh node of the model. The 
+file shrinks by orders of magnitude, and C2N uses its values directly without triangulating COMSOL's mesh.
+Input:
+fname:          string, optional
+                name of the exported file; the default is "exStimVoltProf.txt"
+samples:        string, optional
+                name of the sample point file; the default is "NEURON2COMSOL_samples.txt"
+"""
+def exportAtSamples(fout, fname="exStimVoltProf.txt", samples="NEURON2COMSOL_samples.txt"):
+
+    txt = \
+        r"""
+    %% export voltage profile at the NEURON sample points
+    fprintf('exporting data ...\n');
+    samples = dlmread(append(fileparts(mfilename('fullpath')), '/%s'), ' ');
+    V = mphinterp(model, 'V', 'coord', samples');
+    fid = fopen(append(fileparts(mfilename('fullpath')), '/%s'), 'w');
+    fprintf(fid, '%%%% x y z V\n');
+    fprintf(fid, '%%.17g %%.17g %%.17g %%.17g\n', [samples'; V(:)']);
+    fclose(fid);
+        """
+    fout.write(txt % (samples, fname))
+
+
+"""
+Write the NEURON sample points, i.e. the centre of every segment, one "x y z" line each, for exportAtSamples().
+Input:
+table:          SectionTable snapshot of the NEURON model
+fname:          string, optional
+                name of the sample point file; the default is "NEURON2COMSOL_samples.txt"
+"""
+def writeSamplePoints(table, fname="NEURON2COMSOL_samples.txt"):
+    np.savetxt(fname, table.segCoords, fmt="%.17g")
+
+
+"""
+Remove the TIME electrode built by buildMonopolarElectrode() or buildHexapolarElectrode(), with its materials and
+current sources, and the fibre materials, so that another electrode configuration can be built in the same model with
+the materials in the same order.
+Input:
+e_type:         string
+                type of electrode: "monopolar" or "hexapolar"
+"""
+def removeElectrode(fout, e_type):
+
+    if e_type == "monopolar":
+        features = ['rot1', 'electrode', 'dif1', 'hole', 'substrate']
+        sources = ['fpe1']
+    else:
+        features = ['rot1', 'stim_electrode'] + ['rtn_electrode%d' % (i) for i in range(1, 7)] + ['dif1', 'stim_hole'] \
+                + ['rtn_hole%d' % (i) for i in range(1, 7)] + ['substrate']
+        sources = ['stim_fpe', 'rtn_fpe']
+
+    txt = \
+        r"""
+    %% remove the previous TIME electrode
+    fprintf('removing TIME electrode ...\n');
+    for tag = {%s}
+        model.component('comp1').geom('geom1').feature.remove(tag{1});
+    end
+    for tag = {%s}
+        model.component('comp1').physics('ec').feature.remove(tag{1});
+    end
+    model.component('comp1').material.remove('matsubstrate');
+    model.component('comp1').material.remove('mate1');
+
+    %% remove the fibre materials too: COMSOL gives the last material precedence on shared domains, so they must be
+    %% recreated after the electrode's, as in the first configuration
+    for tag = cell(model.component('comp1').material.tags())'
+        if startsWith(tag{1}, 'matfibre')
+            model.component('comp1').material.remove(tag{1});
+        end
+    end
+        """
+    fout.write(txt % (' '.join("'%s'" % (f) for f in features), ' '.join("'%s'" % (f) for f in sources)))
+
+
+"""
+Save the COMSOL model as .mph file, named NEURON2COMSOL_auto_conv.mph, and write the stage timings logged by 
+logTiming() to NEURON2COMSOL_timings.json.
 """
 def writeEpilog(fout):
 
@@ -701,36 +953,122 @@ def writeEpilog(fout):
         r"""
     % save model
     fprintf('saving model ...\n');
-    model.save(append(fileparts(matlab.desktop.editor.getActiveFilename), '/NEURON2COMSOL_auto_conv.mph'));
+    model.save(append(fileparts(mfilename('fullpath')), '/NEURON2COMSOL_auto_conv.mph'));
+
+    % write the stage timings
+    timings.total = toc;
+    fid = fopen(append(fileparts(mfilename('fullpath')), '/NEURON2COMSOL_timings.json'), 'w');
+    fprintf(fid, '%s', jsonencode(timings));
+    fclose(fid);
     fprintf('NEURON-to-COMSOL automatic conversion done.\n');
     toc;
         """
     fout.write(txt)
 
 
+"""
+Electrode configurations of a sweep: every combination of the listed e_R and rotate_deg values (or single values), 
+each a dictionary with keys "e_R" and "rotate_deg", in the order the generated script solves them. Shared by all 
+backends, so that their configurations and file names always match.
+"""
+def getConfigs(e_R, rotate_deg):
+    return [{'e_R': r, 'rotate_deg': deg} for r, deg in product(np.atleast_1d(e_R).tolist(), np.atleast_1d(rotate_deg).tolist())]
+
+
+"""
+File name of configuration i (counted from 1) of N: fname itself for a single configuration, otherwise fname with _<i>
+inserted before its extension, e.g. exStimVoltProf_2.txt, or rx_xtra_interpolated_2 for a base name.
+"""
+def sweepFileName(fname, i, N):
+    if N == 1:
+        return fname
+    base, ext = os.path.splitext(fname)
+    return "%s_%d%s" % (base, i, ext)
+
+
 """ 
 Master function.
+Input (in addition to those of the functions above):
+table:          SectionTable, optional
+                snapshot of the NEURON model, e.g. SectionTable.load() of a table saved by another process; the 
+                default is None, which takes a snapshot of the currently loaded NEURON model
+refine_dist:    int or float, optional
+                distance from the TIME electrode within which fascicles are meshed with fasc_mesh_size; the default
+                is 500
+export_mode:    string, optional
+                "mesh" - export the voltage at every mesh node of the model; "points" - export it only at the NEURON 
+                segment centres, see exportAtSamples(); the default is "mesh"
+start_server:   bool, optional
+                whether the script starts the COMSOL server itself, see writePreamble(); the default is True
+workdir:        string, optional
+                directory the MATLAB script and its input tables are written to; the script reads and writes all other
+                files (the .mph model, the voltage profiles) next to itself; the default is "."
+
+Electrode sweep: e_R and rotate_deg also accept lists, e.g. e_R=[50, 100, 200, 400] and rotate_deg=[0, -45, -90]. 
+The generated script then builds the simulation box, nerve, fascicles and fibres once, and for every combination of 
+the listed values (re)builds only the TIME electrode, re-meshes, re-studies and exports exStimVoltProf_<i>.txt, all 
+in one COMSOL session.
+Returns:        list of electrode configurations, each a dictionary with keys "e_R", "rotate_deg" and "volt_file"
 """
 def convert(path2server, path2mph, simBox_3D, simBox_size, nerve_3D, nerve_R, nerve_L, fasc_3D, fasc_R, fasc_L, \
                                 substrate_3D, substrate_W, substrate_L, substrate_D, e_R, \
-                                e_type="monopolar", e2e_dist=None, rotate_deg=0, simBox_G=1.45, nerve_G=0.01, fasc_G=0.0517, mesh_size=3):
+                                e_type="monopolar", e2e_dist=None, rotate_deg=0, simBox_G=1.45, nerve_G=0.01, fasc_G=0.0517, mesh_size=3, \
+                                fibre_merge="none", table=None, e_mesh_size=None, fasc_mesh_size=None, refine_dist=500, \
+                                export_mode="mesh", start_server=True, workdir="."):
+    # take a snapshot of the NEURON model, unless one is given
+    if table is None:
+        table = SectionTable.capture()
+
+    # describe the fibres as COMSOL cylinders, in a table read by the MATLAB file
+    writeFibreTable(getFibreCylinders(table, fibre_merge), os.path.join(workdir, "NEURON2COMSOL_fibres.txt"))
+    if export_mode == "points":
+        writeSamplePoints(table, os.path.join(workdir, "NEURON2COMSOL_samples.txt"))
+    elif export_mode != "mesh":
+        raise ValueError("Incorrect export mode. Mode should be mesh or points. Current mode is: %s" % (export_mode))
+
+    # electrode configurations; a single configuration keeps the usual exStimVoltProf.txt name
+    configs = getConfigs(e_R, rotate_deg)
+    for i, config in enumerate(configs, 1):
+        config['volt_file'] = sweepFileName("exStimVoltProf.txt", i, len(configs))
+
     # write out MATLAB file for COMSOL
-    fout = open("./NEURON2COMSOL_auto_conv.m", 'w')
-    writePreamble(fout, path2server, path2mph)
+    fout = open(os.path.join(workdir, "NEURON2COMSOL_auto_conv.m"), 'w')
+    writePreamble(fout, path2server, path2mph, start_server)
     buildSimBox(fout, simBox_3D, simBox_size, simBox_G)
     buildNerve(fout, nerve_3D, nerve_R, nerve_L, nerve_G)
     buildFascicle(fout, fasc_3D, fasc_R, fasc_L, fasc_G)
+    readFibreTable(fout)
     buildFibreGeom(fout)
-    if e_type == "monopolar":
-        buildMonopolarElectrode(fout, substrate_3D, substrate_W, substrate_L, substrate_D, e_R, rotate_deg)
-    elif e_type == "hexapolar":
-        buildHexapolarElectrode(fout, substrate_3D, substrate_W, substrate_L, substrate_D, e_R, e2e_dist, rotate_deg)
-    else:
-        print("Incorrect electrode type. Electrode should be either monopolar or hexapolar. Current electrode type is: %s\n" % (e_type))
-    getFibreEntityNum(fout)
-    assignFibreConductivity(fout)
-    mesh(fout, mesh_size)
-    study(fout)
-    export(fout)
+    logTiming(fout, "geometry")
+    for i, config in enumerate(configs):
+        if i > 0 and e_type in ("monopolar", "hexapolar"):
+            fout.write("\n    fprintf('electrode configuration %d of %d: e_R = %g, rotate_deg = %g\\n');\n" \
+                    % (i+1, len(configs), config['e_R'], config['rotate_deg']))
+            removeElectrode(fout, e_type)
+        if e_type == "monopolar":
+            buildMonopolarElectrode(fout, substrate_3D, substrate_W, substrate_L, substrate_D, config['e_R'], config['rotate_deg'])
+        elif e_type == "hexapolar":
+            buildHexapolarElectrode(fout, substrate_3D, substrate_W, substrate_L, substrate_D, config['e_R'], e2e_dist, config['rotate_deg'])
+        else:
+            print("Incorrect electrode type. Electrode should be either monopolar or hexapolar. Current electrode type is: %s\n" % (e_type))
+        # the geometry is finalised once the electrode is in, and timed as part of the geometry stage
+        runGeometry(fout)
+        logTiming(fout, "geometry")
+        getFibreEntityNum(fout)
+        logTiming(fout, "entities")
+        assignFibreConductivity(fout)
+        logTiming(fout, "materials")
+        near_fasc = getFasciclesNearElectrode(fasc_3D, fasc_R, substrate_3D, config['rotate_deg'], refine_dist)
+        mesh(fout, mesh_size, e_mesh_size, fasc_mesh_size, near_fasc)
+        logTiming(fout, "mesh")
+        study(fout)
+        logTiming(fout, "study")
+        if export_mode == "points":
+            exportAtSamples(fout, config['volt_file'])
+        else:
+            export(fout, config['volt_file'])
+        logTiming(fout, "export")
     writeEpilog(fout)
-    fout.close()
\ No newline at end of file
+    fout.close()
+
+    return configs
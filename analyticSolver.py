@@ -0,0 +1,218 @@
+'''
+This file is automatically run by the toolkit when the analytic backend is selected. Or, it can be seperately run by
+users.
+
+It replaces the COMSOL model by closed-form potentials of the TIME electrode's contacts in an infinite medium,
+homogeneous as seen from each segment, and writes the transfer resistance of every NEURON segment directly, in seconds
+and without MATLAB or COMSOL. It is meant for screening studies; the COMSOL backend remains the reference.
+
+Three simplifications are made:
+(1) each segment sees a homogeneous medium, whose conductivity combines in series those of the regions (simulation
+    box, nerve or fascicle) on the path from the contact to the segment, see getEffectiveConductivity(); a region's
+    conductivity may be anisotropic, [longitudinal (x), transverse (y, z)],
+(2) the grounded simulation box boundaries, the substrate and the fibres are not modelled,
+(3) each contact is a point source or an equipotential disc facing the substrate's normal.
+'''
+
+import os
+import numpy as np
+import COMSOL2NEURON_auto_conv as C2N
+import NEURON2COMSOL_auto_conv as N2C
+from sectionTable import SectionTable
+
+
+"""
+Positions, currents and common normal of the TIME electrode's contacts, placed as in NEURON2COMSOL_auto_conv.m: the
+contacts' exposed faces lie a quarter of the substrate depth above its centre, and TIME is rotated along x-axis
+through the origin.
+Input:
+substrate_3D:   array_like
+                [x, y, z] position of the centre of the TIME substrate
+substrate_D:    int or float
+                depth of the TIME subtrate
+e_R:            int or float
+                radius of the stimulating TIME electrode
+e_type:         string, optional
+                type of electrode: "monopolar" or "hexapolar"; the default is "monopolar"
+e2e_dist:       int or float, optional
+                electrode-to-electrode distance of the hexapolar TIME electrode; the default is None, which translates
+                to 4 times the electrode radius
+rotate_deg:     int or float, optional
+                rotation of TIME along x-axis in degree; the default is 0
+Returns:        (N_contacts, 3) array of positions, (N_contacts,) array of currents relative to the stimulating
+                current, and the (3,) unit normal of the contacts' faces
+"""
+def getContacts(substrate_3D, substrate_D, e_R, e_type="monopolar", e2e_dist=None, rotate_deg=0):
+    if e2e_dist == None:
+        e2e_dist = e_R*4
+
+    centre = np.array([substrate_3D[0], substrate_3D[1], substrate_3D[2] + substrate_D/4], dtype=float)
+    if e_type == "monopolar":
+        pos = centre[None, :]
+        I = np.array([1.0])
+    elif e_type == "hexapolar":
+        # the six return contacts share the stimulating current, as the COMSOL floating potential group does
+        angles = np.deg2rad([0, 180, 60, 120, 240, 300])
+        pos = np.vstack((centre, centre + e2e_dist*np.column_stack((np.cos(angles), np.sin(angles), np.zeros(6)))))
+        I = np.array([1.0] + [-1/6]*6)
+    else:
+        raise ValueError("Incorrect electrode type. Electrode should be either monopolar or hexapolar. Current electrode type is: %s" % (e_type))
+
+    theta = np.deg2rad(rotate_deg)
+    rot = np.array([[1, 0, 0], [0, np.cos(theta), -np.sin(theta)], [0, np.sin(theta), np.cos(theta)]])
+    return pos @ rot.T, I, rot @ np.array([0.0, 0.0, 1.0])
+
+
+"""
+Conductivity of the region containing each point: a fascicle, else the nerve, else the simulation box. Each
+conductivity is a float, or [longitudinal, transverse] for a medium anisotropic along x-axis.
+Input:
+points:         (..., 3) array of positions (unit: um)
+Returns:        (..., 3) array of the conductivity along x, y and z
+"""
+def getConductivity(points, nerve_3D, nerve_R, nerve_L, fasc_3D, fasc_R, fasc_L, simBox_G=1.45, nerve_G=0.01, \
+                                fasc_G=0.0517):
+    points = np.asarray(points, dtype=float)
+
+    def inCylinder(start, R, L):
+        return (points[..., 0] >= start[0]) & (points[..., 0] <= start[0] + L) \
+                & (np.hypot(points[..., 1] - start[1], points[..., 2] - start[2]) <= R)
+
+    def diag(G):
+        G = np.atleast_1d(np.asarray(G, dtype=float))
+        return np.array([G[0], G[-1], G[-1]])
+
+    G = np.broadcast_to(diag(simBox_G), points.shape).copy()
+    G[inCylinder(nerve_3D, nerve_R, nerve_L)] = diag(nerve_G)
+    for start, R in zip(np.asarray(fasc_3D, dtype=float).reshape(-1, 3), np.atleast_1d(fasc_R)):
+        G[inCylinder(start, R, fasc_L)] = diag(fasc_G)
+    return G
+
+
+"""
+Effective conductivity seen by each segment from a contact: the conductivities of the regions crossed by the straight
+path from the contact to the segment, combined in series, i.e. the resistivity averaged over N_samples points evenly
+spread along the path. A segment in a fascicle behind a layer of nerve tissue thus sees both. This remains an
+approximation: current spreading around the path, the insulating substrate and the grounded simulation box are not
+accounted for.
+Input:
+coords:         (N, 3) array of positions (unit: um)
+contact:        (3,) position of the contact (unit: um)
+N_samples:      int, optional
+                number of points averaged along each path; the default is 32
+other inputs as in getConductivity()
+Returns:        (N, 3) array of the conductivity along x, y and z
+"""
+def getEffectiveConductivity(coords, contact, nerve_3D, nerve_R, nerve_L, fasc_3D, fasc_R, fasc_L, simBox_G=1.45, \
+                                nerve_G=0.01, fasc_G=0.0517, N_samples=32):
+    f = (np.arange(N_samples) + 0.5) / N_samples
+    points = contact + (np.asarray(coords, dtype=float) - contact)[:, None, :] * f[None, :, None]
+    rho = 1 / getConductivity(points, nerve_3D, nerve_R, nerve_L, fasc_3D, fasc_R, fasc_L, simBox_G, nerve_G, fasc_G)
+    return 1 / rho.mean(axis=1)
+
+
+"""
+Transfer resistance (unit: ohm) of a point source in an infinite, homogeneous, anisotropic medium:
+rx = 1 / (4*pi*sqrt(Gx*Gy*Gz) * sqrt(x^2/Gx + y^2/Gy + z^2/Gz)), which is 1 / (4*pi*G*r) when isotropic.
+Distances below the contact radius are clipped to it.
+Input:
+coords:         (N, 3) array of positions (unit: um)
+contact:        (3,) position of the point source (unit: um)
+G:              (3,) or (N, 3) conductivity along x, y and z, for all or for each position (unit: S/m)
+e_R:            radius of the contact (unit: um)
+"""
+def pointSourceRx(coords, contact, G, e_R):
+    d = (np.asarray(coords) - contact) * 1e-6
+    s = np.sqrt(np.sum(d**2 / G, axis=1))
+    s = np.maximum(s, e_R*1e-6 / np.sqrt(G.max(axis=-1)))
+    return 1 / (4*np.pi*np.sqrt(np.prod(G, axis=-1)) * s)
+
+
+"""
+Transfer resistance (unit: ohm) of an equipotential disc in an infinite, homogeneous medium:
+rx = arcsin(2a / (sqrt((rho-a)^2 + z^2) + sqrt((rho+a)^2 + z^2))) / (4*pi*G*a), with rho the distance from the disc's
+axis and z the distance along its normal; it tends to the point source far from the disc. An anisotropic medium is
+mapped onto an isotropic one of conductivity (Gx*Gy*Gz)^(1/3) by scaling the coordinates, which keeps the far field
+exact and approximates the near field.
+Input:
+coords:         (N, 3) array of positions (unit: um)
+contact:        (3,) position of the centre of the disc (unit: um)
+normal:         (3,) unit normal of the disc
+G:              (3,) or (N, 3) conductivity along x, y and z, for all or for each position (unit: S/m)
+e_R:            radius of the disc (unit: um)
+"""
+def discRx(coords, contact, normal, G, e_R):
+    G_iso = np.prod(G, axis=-1, keepdims=True)**(1/3)
+    d = (np.asarray(coords) - contact) * np.sqrt(G_iso / G) * 1e-6
+    z = d @ normal
+    rho = np.sqrt(np.maximum(np.sum(d**2, axis=1) - z**2, 0))
+    a = e_R*1e-6
+    return np.arcsin(np.minimum(2*a / (np.hypot(rho - a, z) + np.hypot(rho + a, z)), 1)) / (4*np.pi*G_iso[..., 0]*a)
+
+
+"""
+Transfer resistance of every NEURON segment to the TIME electrode, superposing the contacts by their currents.
+Input:
+coords:         (N_segments, 3) array of the segment centres
+source:         string, optional
+                contact model: "point" or "disc"; the default is "disc"
+other inputs as in convert()
+Returns:        (N_segments,) array of transfer resistance (unit: ohm)
+"""
+def solve(coords, nerve_3D, nerve_R, nerve_L, fasc_3D, fasc_R, fasc_L, substrate_3D, substrate_D, e_R, \
+                                e_type="monopolar", e2e_dist=None, rotate_deg=0, simBox_G=1.45, nerve_G=0.01, fasc_G=0.0517, \
+                                source="disc"):
+    pos, I, normal = getContacts(substrate_3D, substrate_D, e_R, e_type, e2e_dist, rotate_deg)
+
+    rx = np.zeros(len(coords))
+    for p, i in zip(pos, I):
+        G = getEffectiveConductivity(coords, p, nerve_3D, nerve_R, nerve_L, fasc_3D, fasc_R, fasc_L, simBox_G, \
+                                nerve_G, fasc_G)
+        if source == "point":
+            rx += i * pointSourceRx(coords, p, G, e_R)
+        elif source == "disc":
+            rx += i * discRx(coords, p, normal, G, e_R)
+        else:
+            raise ValueError("Incorrect source model. Source should be either point or disc. Current source is: %s" % (source))
+    return rx
+
+
+"""
+Master function. Takes the same geometry and conductivity arguments as N2C.convert() (simBox_3D, simBox_size,
+substrate_W and substrate_L are accepted but not used by the analytic model), and a list of e_R or rotate_deg sweeps
+the electrode likewise.
+Input:
+source:         string, optional
+                contact model: "point" or "disc"; the default is "disc"
+table:          SectionTable, optional
+                snapshot of the NEURON model; the default is None, which takes a snapshot of the currently loaded
+                NEURON model
+assign:         bool, optional
+                whether to assign the transfer resistance of a single configuration to the loaded NEURON model with
+                C2N.setrx(); the default is True
+rx_dtype:       numpy dtype, optional
+                float precision of the name-keyed rx store, see C2N.RxStore; the default is np.float64
+workdir:        string, optional
+                directory the transfer resistance files are written to; the default is "."
+Returns:        list of configurations (e_R, rotate_deg, rx_file); a single configuration is written to
+                rx_xtra_interpolated.txt (and .npy/.json), a sweep to rx_xtra_interpolated_<i>.txt, unassigned
+"""
+def convert(simBox_3D, simBox_size, nerve_3D, nerve_R, nerve_L, fasc_3D, fasc_R, fasc_L, \
+                                substrate_3D, substrate_W, substrate_L, substrate_D, e_R, \
+                                e_type="monopolar", e2e_dist=None, rotate_deg=0, simBox_G=1.45, nerve_G=0.01, fasc_G=0.0517, \
+                                source="disc", table=None, assign=True, rx_dtype=np.float64, workdir="."):
+    # take a snapshot of the NEURON model, unless one is given
+    if table is None:
+        table = SectionTable.capture()
+
+    configs = N2C.getConfigs(e_R, rotate_deg)
+    for i, config in enumerate(configs, 1):
+        config['rx_file'] = N2C.sweepFileName("rx_xtra_interpolated", i, len(configs))
+        rx = solve(table.segCoords, nerve_3D, nerve_R, nerve_L, fasc_3D, fasc_R, fasc_L, substrate_3D, substrate_D, \
+                                config['e_R'], e_type, e2e_dist, config['rotate_deg'], simBox_G, nerve_G, fasc_G, source)
+        C2N.saverx(table, rx, os.path.join(workdir, config['rx_file']), rx_dtype)
+
+    # assign the transfer resistance to each NEURON segment
+    if assign and len(configs) == 1:
+        C2N.setrx(rx)
+    return configs
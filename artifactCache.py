@@ -0,0 +1,109 @@
+'''
+This file is automatically run by the toolkit. Or, it can be seperately run by users.
+
+It keeps the output files of each pipeline stage (the MATLAB script, the COMSOL model, the voltage profiles and the
+transfer resistances) in a local, content-addressed cache, so that a run whose inputs are identical to a previous run
+copies the files back instead of recomputing them.
+'''
+
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import numpy as np
+
+
+"""
+Content-addressed cache of stage outputs. An entry is a directory <root>/<key>, where key is a hash of everything a
+stage's output depends on: the stage arguments and, through the key of the previous stage, its inputs. An entry holds
+copies of the stage's output files and a meta.json with any value the stage returns, e.g. the electrode
+configurations. Entries are evicted least recently used first once the cache grows over max_bytes.
+Keys are computed from the inputs, never from the output files: NEURON2COMSOL_auto_conv.m, for instance, carries its
+creation time, so hashing it would never hit.
+Input:
+root:           string, optional
+                directory of the cache; the default is "artifact_cache"
+max_bytes:      int, optional
+                size above which least recently used entries are evicted; the default is 2 GB
+"""
+class ArtifactCache:
+
+    def __init__(self, root="artifact_cache", max_bytes=2 << 30):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    """
+    Key of a stage: a hash of the stage name and its inputs, which may be nested lists, dictionaries, numbers, strings
+    and NumPy arrays. Pass the key of the previous stage as an input to chain the stages.
+    """
+    @staticmethod
+    def key(stage, **inputs):
+        txt = json.dumps([stage, inputs], sort_keys=True, default=lambda o: np.asarray(o).tolist())
+        return hashlib.sha1(txt.encode()).hexdigest()
+
+    """
+    Copy the files of an entry into the directory dest and mark the entry as recently used. The files are copied to
+    temporary names first, so that an entry evicted by another worker halfway through is a miss, not a partial copy.
+    Returns:        the entry's meta value, or None if the key is not cached
+    """
+    def fetch(self, key, dest="."):
+        entry = os.path.join(self.root, key)
+        tmp = ".%s.tmp" % (uuid.uuid4().hex)
+        copied = []
+        try:
+            with open(os.path.join(entry, "meta.json")) as f:
+                meta = json.load(f)
+            os.utime(entry)
+            for fname in meta['files']:
+                shutil.copy2(os.path.join(entry, fname), os.path.join(dest, fname + tmp))
+                copied.append(fname)
+        except OSError:
+            for fname in copied:
+                os.remove(os.path.join(dest, fname + tmp))
+            return None
+
+        for fname in copied:
+            os.replace(os.path.join(dest, fname + tmp), os.path.join(dest, fname))
+        return meta['value']
+
+    """
+    Store copies of the given files of the directory src, with a JSON-serialisable meta value, under a key. Concurrent
+    stores of one key keep the first; the entries are identical.
+    """
+    def store(self, key, files, value=None, src="."):
+        entry = os.path.join(self.root, key)
+        tmp = entry + ".%s.tmp" % (uuid.uuid4().hex)
+        os.makedirs(tmp)
+        for fname in files:
+            shutil.copy2(os.path.join(src, fname), os.path.join(tmp, os.path.basename(fname)))
+        with open(os.path.join(tmp, "meta.json"), 'w') as f:
+            json.dump({'files': [os.path.basename(fname) for fname in files], 'value': value}, f)
+        try:
+            os.replace(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    """
+    Remove least recently used entries until the cache is no larger than max_bytes.
+    """
+    def evict(self):
+        entries = []
+        for key in os.listdir(self.root):
+            entry = os.path.join(self.root, key)
+            if key.endswith(".tmp") or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, fname)) for fname in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+            except OSError:
+                # evicted by another worker meanwhile
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
@@ -10,28 +10,237 @@ validated, and high-quality models in the literature (e.g., Sundt, Gamper, & Jaf
 & Grill, 2002: MRG). This eliminates the need to re-create and re-validate models from scratch. 
 '''
 
-import matlab.engine
+import os
+import asyncio
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import NEURON2COMSOL_auto_conv as N2C
 import COMSOL2NEURON_auto_conv as C2N
+import analyticSolver
+import fdmSolver
+from sectionTable import SectionTable
+from artifactCache import ArtifactCache
+from comsolSession import SessionPool
+from runReport import RunReport, stage
+
+
+"""
+Run a pipeline stage, unless its output files are cached under key, in which case they are copied back into workdir
+instead. run() performs the stage and returns its value (JSON-serialisable) and the list of its output files in
+workdir. The cache lookup is timed as stage <name>/cache of report.
+"""
+def cachedStage(cache, key, run, workdir=".", report=None, name="stage"):
+    if cache is not None:
+        with stage(report, name + "/cache"):
+            value = cache.fetch(key, workdir)
+        if value is not None:
+            print("stage outputs found in the artifact cache, skipped\n")
+            return value
+    value, files = run()
+    if cache is not None:
+        cache.store(key, files, value, workdir)
+    return value
+
+
+"""
+Output files of each electrode configuration of a stage.
+"""
+def configFiles(configs, key):
+    if key == 'rx_file':
+        return [config['rx_file'] + ext for config in configs for ext in (".txt", ".npy", ".json")]
+    return [config[key] for config in configs]
+
 
 def pipeline(path2server, path2mph, simBox_3D, simBox_size, nerve_3D, nerve_R, nerve_L, fasc_3D, fasc_R, fasc_L, \
                                 substrate_3D, substrate_W, substrate_L, substrate_D, e_R, \
-                                e_type="monopolar", e2e_dist=None, rotate_deg=0, simBox_G=1.45, nerve_G=0.01, fasc_G=0.0517, mesh_size=3):
+                                e_type="monopolar", e2e_dist=None, rotate_deg=0, simBox_G=1.45, nerve_G=0.01, fasc_G=0.0517, mesh_size=3, \
+                                fibre_merge="none", e_mesh_size=None, fasc_mesh_size=None, refine_dist=500, \
+                                export_mode="mesh", backend="comsol", cache_dir="artifact_cache", cache_size=2 << 30, \
+                                session=None, table=None, assign=True, workdir=".", report="run_report.json"):
+
+    run_report = RunReport()
 
-    # automatically generate MATLAB script for the COMSOL nerve model
-    print("NEURON TO COMSOL conversion ...\n")
-    N2C.convert(path2server, path2mph, simBox_3D, simBox_size, nerve_3D, nerve_R, nerve_L, fasc_3D, fasc_R, fasc_L, \
+    # take one snapshot of the NEURON model, shared by both conversions, unless one is given
+    if table is None:
+        with run_report.stage("snapshot"):
+            table = SectionTable.capture()
+
+    # every stage is keyed on the model it solves: the NEURON sections, geometry, electrode and conductivities
+    cache = ArtifactCache(cache_dir, cache_size) if cache_dir is not None else None
+    model_key = ArtifactCache.key("model", table=table.hash(), simBox_3D=simBox_3D, simBox_size=simBox_size, \
+                                nerve_3D=nerve_3D, nerve_R=nerve_R, nerve_L=nerve_L, fasc_3D=fasc_3D, fasc_R=fasc_R, \
+                                fasc_L=fasc_L, substrate_3D=substrate_3D, substrate_W=substrate_W, substrate_L=substrate_L, \
+                                substrate_D=substrate_D, e_R=e_R, e_type=e_type, e2e_dist=e2e_dist, rotate_deg=rotate_deg, \
+                                simBox_G=simBox_G, nerve_G=nerve_G, fasc_G=fasc_G)
+
+    if backend == "analytic":
+        # the analytic backend writes the transfer resistance directly, without MATLAB or COMSOL
+        print("analytic field solution ...\n")
+        def runAnalytic():
+            with run_report.stage("analytic"):
+                configs = analyticSolver.convert(simBox_3D, simBox_size, nerve_3D, nerve_R, nerve_L, fasc_3D, fasc_R, fasc_L, \
+                                substrate_3D, substrate_W, substrate_L, substrate_D, e_R, \
+                                e_type, e2e_dist, rotate_deg, simBox_G, nerve_G, fasc_G, table=table, assign=False, \
+                                workdir=workdir)
+            return configs, configFiles(configs, 'rx_file')
+        configs = cachedStage(cache, ArtifactCache.key("analytic", model=model_key), runAnalytic, workdir, run_report, "analytic")
+    else:
+        if backend == "fdm":
+            # the finite-difference backend exports the voltage profile in COMSOL's format, without MATLAB or COMSOL,
+            # always at the segment centres: interpolating on its grid is far cheaper than exporting every grid node
+            print("finite-difference field solution ...\n")
+            def runSolver():
+                with run_report.stage("fdm"):
+                    configs = fdmSolver.convert(simBox_3D, simBox_size, nerve_3D, nerve_R, nerve_L, fasc_3D, fasc_R, fasc_L, \
                                 substrate_3D, substrate_W, substrate_L, substrate_D, e_R, \
-                                e_type, e2e_dist, rotate_deg, simBox_G, nerve_G, fasc_G, mesh_size)
+                                e_type, e2e_dist, rotate_deg, simBox_G, nerve_G, fasc_G, export_mode="points", table=table, \
+                                workdir=workdir)
+                return configs, configFiles(configs, 'volt_file')
+            solve_key = ArtifactCache.key("fdm", model=model_key, export_mode="points")
+        elif backend == "comsol":
+            def runSolver():
+                # automatically generate MATLAB script for the COMSOL nerve model
+                print("NEURON TO COMSOL conversion ...\n")
+                with run_report.stage("n2c"):
+                    configs = N2C.convert(path2server, path2mph, simBox_3D, simBox_size, nerve_3D, nerve_R, nerve_L, fasc_3D, fasc_R, fasc_L, \
+                                substrate_3D, substrate_W, substrate_L, substrate_D, e_R, \
+                                e_type, e2e_dist, rotate_deg, simBox_G, nerve_G, fasc_G, mesh_size, fibre_merge, table, \
+                                e_mesh_size, fasc_mesh_size, refine_dist, export_mode, session is None, workdir)
+
+                # automatically initiate MATLAB with LiveLink, and run the COMSOL model from MATLAB; a session keeps 
+                # MATLAB and the COMSOL server running for the next call
+                print("running MATLAB ...\n")
+                if session is not None:
+                    with run_report.stage("matlab_run"):
+                        session.run("NEURON2COMSOL_auto_conv", workdir)
+                else:
+                    import matlab.engine
+                    with run_report.stage("matlab_start"):
+                        eng = matlab.engine.start_matlab()
+                    with run_report.stage("matlab_run"):
+                        eng.cd(os.path.abspath(workdir), nargout=0)
+                        eng.NEURON2COMSOL_auto_conv(nargout=0)
+                    eng.quit()
+
+                files = ["NEURON2COMSOL_auto_conv.m", "NEURON2COMSOL_fibres.txt", "NEURON2COMSOL_auto_conv.mph", \
+                                "NEURON2COMSOL_timings.json"]
+                if export_mode == "points":
+                    files.append("NEURON2COMSOL_samples.txt")
+                return configs, files + configFiles(configs, 'volt_file')
+            solve_key = ArtifactCache.key("comsol", model=model_key, mesh_size=mesh_size, fibre_merge=fibre_merge, \
+                                e_mesh_size=e_mesh_size, fasc_mesh_size=fasc_mesh_size, refine_dist=refine_dist, \
+                                export_mode=export_mode, version=N2C.version)
+        else:
+            raise ValueError("Incorrect backend. Backend should be comsol, fdm or analytic. Current backend is: %s" % (backend))
+        configs = cachedStage(cache, solve_key, runSolver, workdir, run_report, backend)
+
+        # automatically export COMSOL's extracellular voltage data as a .txt file ready to be imported back to NEURON
+        print("COMSOL to NEURON conversion ...\n")
+        def runC2N():
+            for i, config in enumerate(configs, 1):
+                # electrode sweep: one transfer resistance file per configuration
+                config['rx_file'] = N2C.sweepFileName("rx_xtra_interpolated", i, len(configs))
+                C2N.convert(volt_file=os.path.join(workdir, config['volt_file']), table=table, assign=False, \
+                                rx_file=os.path.join(workdir, config['rx_file']), report=run_report)
+            return configs, configFiles(configs, 'rx_file')
+        configs = cachedStage(cache, ArtifactCache.key("c2n", solve=solve_key), runC2N, workdir, run_report, "c2n")
+
+    # a single configuration is assigned to the NEURON model; a sweep's are left for C2N.loadrx()
+    if assign and len(configs) == 1:
+        with run_report.stage("setrx"):
+            C2N.loadrx(os.path.join(workdir, configs[0]['rx_file'] + ".npy"))
+
+    # one JSON report of the run: Python stage timings, MATLAB stage timings and mesh size, model and file sizes
+    if report is not None:
+        run_report.add(backend=backend, sections=int(table.Nsec), segments=int(table.Nseg), configurations=len(configs))
+        if backend == "comsol":
+            run_report.addMatlab(os.path.join(workdir, "NEURON2COMSOL_timings.json"))
+        fnames = [config['volt_file'] for config in configs if 'volt_file' in config] + configFiles(configs, 'rx_file')
+        if backend == "comsol":
+            fnames += ["NEURON2COMSOL_auto_conv.m", "NEURON2COMSOL_fibres.txt", "NEURON2COMSOL_auto_conv.mph"]
+        run_report.addFiles([os.path.join(workdir, fname) for fname in fnames])
+        run_report.save(os.path.join(workdir, report))
+
+    print("Automated pipeline finishes !\n")
+    return configs
+
+
+"""
+Runs pipeline() jobs concurrently, each in its own new workspace directory <root>/job_<random>, so that the fixed file
+names of the stages collide neither between jobs nor with other runners or earlier runs, and the Python work of one
+job (C2N's interpolation) overlaps with the field solution of another. submit() returns a concurrent.futures.Future at once, and run() is its asyncio counterpart:
+    with tk.PipelineRunner(max_workers=4) as runner:
+        jobs = [runner.submit(path2server, path2mph, ..., e_R=r) for r in [50, 100, 200, 400]]
+        configs = [job.result() for job in jobs]
+The NEURON model is snapshotted when a job is submitted, in the calling thread, since NEURON is not thread-safe; for
+the same reason the jobs do not assign their transfer resistance: load it with C2N.loadrx(config['rx_file'] + ".npy"),
+the returned paths pointing into the job's workspace. COMSOL jobs run on a SessionPool, one MATLAB engine and COMSOL
+server port per worker.
+Input:
+max_workers:    int, optional
+                number of jobs running at once; the default is 4
+root:           string, optional
+                directory of the job workspaces; the default is "pipeline_jobs"
+pool:           SessionPool, optional
+                sessions for COMSOL jobs; the default is None, which starts a pool of max_workers sessions on first
+                use and closes it on shutdown()
+"""
+class PipelineRunner:
+
+    def __init__(self, max_workers=4, root="pipeline_jobs", pool=None):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.root = root
+        self.pool = pool
+        self.own_pool = False
+
+    """
+    Submit a job with the arguments of pipeline().
+    Returns:        Future of the list of configurations, whose volt_file and rx_file point into the job's workspace
+    """
+    def submit(self, *args, **kwargs):
+        if kwargs.get('table') is None:
+            kwargs['table'] = SectionTable.capture()
+        os.makedirs(self.root, exist_ok=True)
+        kwargs['workdir'] = tempfile.mkdtemp(prefix="job_", dir=self.root)
+        kwargs['assign'] = False
+
+        if kwargs.get('backend', "comsol") == "comsol" and kwargs.get('session') is None and self.pool is None:
+            path2server = args[0] if len(args) > 0 else kwargs['path2server']
+            path2mph = args[1] if len(args) > 1 else kwargs['path2mph']
+            self.pool = SessionPool(self.max_workers, path2server, path2mph)
+            self.own_pool = True
+        return self.executor.submit(self.runJob, args, kwargs)
+
+    def runJob(self, args, kwargs):
+        if kwargs.get('backend', "comsol") == "comsol" and kwargs.get('session') is None:
+            kwargs.pop('session', None)
+            with self.pool.session() as session:
+                configs = pipeline(*args, session=session, **kwargs)
+        else:
+            configs = pipeline(*args, **kwargs)
+
+        for config in configs:
+            for key in ('volt_file', 'rx_file'):
+                if key in config:
+                    config[key] = os.path.join(kwargs['workdir'], config[key])
+        return configs
+
+    """
+    Submit a job and await its configurations from asyncio.
+    """
+    async def run(self, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(*args, **kwargs))
 
-    # automatically initiate MATLAB with LiveLink, and run the COMSOL model from MATLAB
-    print("running MATLAB ...\n")
-    eng = matlab.engine.start_matlab()
-    eng.NEURON2COMSOL_auto_conv(nargout=0)
-    eng.quit()
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        if self.own_pool:
+            self.pool.close()
+            self.pool = None
+            self.own_pool = False
 
-    # automatically export COMSOL's extracellular voltage data as a .txt file ready to be imported back to NEURON
-    print("COMSOL to NEURON conversion ...\n")
-    C2N.convert()
+    def __enter__(self):
+        return self
 
-    print("Automated pipeline finishes !\n")
\ No newline at end of file
+    def __exit__(self, *exc):
+        self.shutdown()
@@ -0,0 +1,160 @@
+'''
+This file is automatically run by the toolkit when a session is given to the pipeline. Or, it can be seperately run by
+users.
+
+It keeps one MATLAB engine, linked through LiveLink to one COMSOL server, alive across many generated scripts, so that
+a sweep of pipeline() calls pays the MATLAB and COMSOL start-up once instead of per call. A bounded pool of sessions,
+each on its own COMSOL server port, serves concurrent workers.
+
+The MATLAB engine is created by an engine factory, matlab.engine.start_matlab by default. Any object providing
+eval(command, nargout=0), cd(folder, nargout=0), quit() and the generated script as a method (e.g.
+engine.NEURON2COMSOL_auto_conv(nargout=0)) can stand in for it, e.g. a local fake engine for testing.
+'''
+
+import os
+from queue import Queue
+from contextlib import contextmanager
+
+
+"""
+One MATLAB engine with a COMSOL server started from it and linked by mphstart(port).
+Input:
+path2server:    string
+                absolute path to COMSOL server's execution file comsolmphserver.exe
+path2mph:       string
+                absolute path to COMSOL's MATLAB with LiveLink file mphstart.m
+port:           int, optional
+                port of the COMSOL server; the default is 2036
+engine_factory: callable, optional
+                returns a new MATLAB engine; the default is None, which uses matlab.engine.start_matlab
+max_restarts:   int, optional
+                number of times a failed script is retried on a restarted session; the default is 1
+"""
+class ComsolSession:
+
+    def __init__(self, path2server, path2mph, port=2036, engine_factory=None, max_restarts=1):
+        self.path2server = path2server
+        self.path2mph = path2mph
+        self.port = port
+        self.engine_factory = engine_factory
+        self.max_restarts = max_restarts
+        self.engine = None
+
+    """
+    Start MATLAB, start the COMSOL server from it on the session's port and link them, unless already started.
+    """
+    def start(self):
+        if self.engine is not None:
+            return
+        if self.engine_factory is None:
+            import matlab.engine
+            self.engine_factory = matlab.engine.start_matlab
+        print("starting MATLAB and COMSOL server on port %d ...\n" % (self.port))
+        self.engine = self.engine_factory()
+        self.engine.eval("cd '%s'; system('comsolmphserver.exe -port %d &'); cd '%s'; mphstart(%d);" \
+                % (self.path2server, self.port, self.path2mph, self.port), nargout=0)
+
+    """
+    Whether MATLAB responds and is still linked to the COMSOL server, i.e. mphtags lists the server's models.
+    """
+    def healthy(self):
+        if self.engine is None:
+            return False
+        try:
+            self.engine.eval("mphtags;", nargout=0)
+            return True
+        except Exception:
+            return False
+
+    """
+    Disconnect from the COMSOL server and quit MATLAB. A server that outlives MATLAB is linked again by the next
+    start() on the same port.
+    """
+    def close(self):
+        if self.engine is not None:
+            try:
+                self.engine.eval("com.comsol.model.util.ModelUtil.disconnect;", nargout=0)
+                self.engine.quit()
+            except Exception:
+                pass
+            self.engine = None
+
+    def restart(self):
+        self.close()
+        self.start()
+
+    """
+    Run a generated script (written with N2C.convert(start_server=False)) in the given folder, restarting the session
+    first if it is not healthy, and once more per allowed restart if the script fails.
+    Input:
+    script:         string, optional
+                    name of the script; the default is "NEURON2COMSOL_auto_conv"
+    folder:         string, optional
+                    folder holding the script; the default is None, which is the current working directory
+    """
+    def run(self, script="NEURON2COMSOL_auto_conv", folder=None):
+        for attempt in range(self.max_restarts + 1):
+            if not self.healthy():
+                self.restart()
+            try:
+                self.engine.cd(os.path.abspath(folder or os.getcwd()), nargout=0)
+                # drop MATLAB's cached copy of a script rewritten since its last run
+                self.engine.eval("clear %s" % (script), nargout=0)
+                getattr(self.engine, script)(nargout=0)
+                return
+            except Exception as err:
+                if attempt == self.max_restarts:
+                    raise
+                print("%s failed (%s), restarting the session ...\n" % (script, err))
+                self.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+"""
+Bounded pool of sessions for concurrent workers; session i runs its COMSOL server on port base_port + i. Sessions are
+started on first use and handed out one worker at a time.
+Input:
+size:           int
+                maximum number of sessions, i.e. of MATLAB engines and COMSOL servers alive at once
+base_port:      int, optional
+                COMSOL server port of the first session; the default is 2036
+other inputs as in ComsolSession
+"""
+class SessionPool:
+
+    def __init__(self, size, path2server, path2mph, base_port=2036, engine_factory=None, max_restarts=1):
+        self.sessions = [ComsolSession(path2server, path2mph, base_port + i, engine_factory, max_restarts) \
+                for i in range(size)]
+        self.idle = Queue()
+        for session in self.sessions:
+            self.idle.put(session)
+
+    """
+    Borrow a session, blocking until one is idle:
+        with pool.session() as session:
+            tk.pipeline(..., session=session)
+    """
+    @contextmanager
+    def session(self):
+        session = self.idle.get()
+        try:
+            session.start()
+            yield session
+        finally:
+            self.idle.put(session)
+
+    def close(self):
+        for session in self.sessions:
+            session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
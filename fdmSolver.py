@@ -0,0 +1,275 @@
+'''
+This file is automatically run by the toolkit when the finite-difference backend is selected. Or, it can be
+seperately run by users.
+
+It solves the same volume conductor as the COMSOL model (simulation box, nerve, fascicles, and the insulating TIME
+substrate with its recessed contacts) on a rectilinear grid with SciPy, without MATLAB or COMSOL, and exports the
+voltage profile as a .txt file in the format of COMSOL's export, which C2N converts as usual.
+
+In detail, four steps are implemented sequentially for each electrode configuration:
+(1) build a grid that is fine around the TIME electrode and coarsens geometrically towards the simulation box,
+(2) assign each grid node the conductivity of the element it lies in,
+(3) assemble the sparse conductance matrix of the grid and inject the contacts' currents, with the simulation box
+    boundaries as electric ground,
+(4) solve for the voltage with the conjugate gradient method, and export it.
+
+The fibres are not voxelised; like the fascicle, they conduct little compared with the contrasts that shape the field.
+'''
+
+import os
+import numpy as np
+from itertools import product
+from scipy import sparse
+from scipy.sparse.linalg import cg, LinearOperator
+from scipy.interpolate import RegularGridInterpolator
+from analyticSolver import getContacts
+import NEURON2COMSOL_auto_conv as N2C
+
+
+"""
+Grid coordinates along one axis, spaced h_min at centre and growing by a factor growth per step up to h_max, towards
+both ends of [lo, hi]. Within box, an interval around centre, the spacing grows only up to h_box.
+"""
+def gradedAxis(lo, hi, centre, h_min, h_max, growth=1.2, box=None, h_box=None):
+    centre = min(max(centre, lo), hi)
+    sides = []
+    for end in (lo, hi):
+        pts = []
+        pos = centre
+        h = h_min
+        while abs(end - pos) > h:
+            pos = pos + np.sign(end - pos)*h
+            pts.append(pos)
+            inBox = box is not None and box[0] <= pos <= box[1]
+            h = min(h*growth, h_box if inBox else h_max)
+        pts.append(end)
+        sides.append(pts)
+    return np.unique(np.concatenate((sides[0], [centre], sides[1])))
+
+
+"""
+Axis-aligned bounding box of the TIME substrate, which COMSOL rotates along x-axis through the origin, padded by pad.
+Returns:        (3,) arrays of the lower and upper corner
+"""
+def getSubstrateBox(substrate_3D, substrate_W, substrate_L, substrate_D, rotate_deg, pad=0):
+    theta = np.deg2rad(rotate_deg)
+    rot = np.array([[1, 0, 0], [0, np.cos(theta), -np.sin(theta)], [0, np.sin(theta), np.cos(theta)]])
+    corners = np.asarray(substrate_3D, dtype=float) + \
+            np.array(list(product([-1, 1], repeat=3))) * [substrate_W/2, substrate_L/2, substrate_D/2]
+    corners = corners @ rot.T
+    return corners.min(axis=0) - pad, corners.max(axis=0) + pad
+
+
+"""
+Conductivity of every grid node, and the grid nodes of each TIME contact with the current it injects.
+Input:
+X:              (N_nodes, 3) array of the grid nodes
+G_range:        (minimum, maximum) conductivity; the insulating substrate and the highly conducting contacts are
+                clipped to it to keep the conductance matrix well conditioned
+other inputs as in convert()
+Returns:        (N_nodes, 3) array of the conductivity along x, y and z, and a list of (node indices, current) per
+                contact
+"""
+def voxelise(X, nerve_3D, nerve_R, nerve_L, fasc_3D, fasc_R, fasc_L, substrate_3D, substrate_W, substrate_L, \
+                                substrate_D, e_R, e_type="monopolar", e2e_dist=None, rotate_deg=0, simBox_G=1.45, \
+                                nerve_G=0.01, fasc_G=0.0517, G_range=(1e-6, 1e3)):
+    def diag(G):
+        G = np.atleast_1d(np.asarray(G, dtype=float))
+        return np.array([G[0], G[-1], G[-1]])
+
+    def inCylinder(start, R, L):
+        return (X[:, 0] >= start[0]) & (X[:, 0] <= start[0] + L) & (np.hypot(X[:, 1] - start[1], X[:, 2] - start[2]) <= R)
+
+    # simulation box, then the nerve, then the fascicles within it
+    sigma = np.tile(diag(simBox_G), (len(X), 1))
+    sigma[inCylinder(nerve_3D, nerve_R, nerve_L)] = diag(nerve_G)
+    for start, R in zip(np.asarray(fasc_3D, dtype=float).reshape(-1, 3), np.atleast_1d(fasc_R)):
+        sigma[inCylinder(start, R, fasc_L)] = diag(fasc_G)
+
+    # the TIME electrode in its own frame, i.e. the nodes rotated back along x-axis
+    theta = np.deg2rad(rotate_deg)
+    rot = np.array([[1, 0, 0], [0, np.cos(theta), -np.sin(theta)], [0, np.sin(theta), np.cos(theta)]])
+    Xs = X @ rot - np.asarray(substrate_3D, dtype=float)
+    substrate = (np.abs(Xs[:, 0]) <= substrate_W/2) & (np.abs(Xs[:, 1]) <= substrate_L/2) & (np.abs(Xs[:, 2]) <= substrate_D/2)
+    pos, I, normal = getContacts([0, 0, 0], substrate_D, e_R, e_type, e2e_dist, 0)
+    holes = []
+    for p in pos:
+        holes.append(np.hypot(Xs[:, 0] - p[0], Xs[:, 1] - p[1]) <= e_R)
+    hole = np.any(holes, axis=0) & (Xs[:, 2] >= 0) & (Xs[:, 2] <= substrate_D/2)
+    sigma[substrate & ~hole] = 1e-99
+
+    # recessed contacts; a contact thinner than the grid falls back to the node nearest its face
+    contacts = []
+    depth = (Xs[:, 2] >= 0) & (Xs[:, 2] <= substrate_D/4)
+    for p, i, inHole in zip(pos, I, holes):
+        nodes = np.flatnonzero(inHole & depth)
+        if len(nodes) == 0:
+            nodes = np.array([np.argmin(np.sum((Xs - p)**2, axis=1))])
+        sigma[nodes] = 1e7
+        contacts.append((nodes, i))
+
+    return np.clip(sigma, G_range[0], G_range[1]), contacts
+
+
+"""
+Assemble the conductance matrix of the grid: neighbouring nodes are linked by sigma*A/d, with sigma the harmonic mean
+of the two nodes' conductivities, A the area of the face between their cells and d their distance; the factor 1e-6
+converts um to m, so that the matrix is in S.
+Input:
+axes:           (x, y, z) grid coordinates along each axis (unit: um)
+sigma:          (N_nodes, 3) array of the conductivity along x, y and z (unit: S/m), nodes ordered as
+                product(x, y, z)
+Returns:        (N_nodes, N_nodes) sparse conductance matrix
+"""
+def assemble(axes, sigma):
+    shape = tuple(len(a) for a in axes)
+    idx = np.arange(np.prod(shape)).reshape(shape)
+    h = [np.diff(a) for a in axes]
+    dual = [(np.concatenate(([0], hd)) + np.concatenate((hd, [0]))) / 2 for hd in h]
+
+    rows = []
+    cols = []
+    vals = []
+    for d in range(3):
+        lo = [slice(None)]*3
+        hi = [slice(None)]*3
+        lo[d] = slice(None, -1)
+        hi[d] = slice(1, None)
+        a = idx[tuple(lo)].ravel()
+        b = idx[tuple(hi)].ravel()
+
+        # face area over node distance, broadcast over the grid
+        w = list(dual)
+        w[d] = 1 / h[d]
+        AoverD = np.multiply.outer(np.multiply.outer(w[0], w[1]), w[2]).ravel()
+        g = 2*sigma[a, d]*sigma[b, d] / (sigma[a, d] + sigma[b, d]) * AoverD * 1e-6
+
+        rows.append(np.concatenate((a, b, a, b)))
+        cols.append(np.concatenate((b, a, a, b)))
+        vals.append(np.concatenate((-g, -g, g, g)))
+
+    N = idx.size
+    return sparse.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=(N, N))
+
+
+"""
+Solve G V = I with the boundary nodes grounded, by the conjugate gradient method with a Jacobi preconditioner.
+Input:
+G:              (N_nodes, N_nodes) sparse conductance matrix
+I:              (N_nodes,) array of the current injected at each node (unit: A)
+boundary:       (N_nodes,) bool array of the grounded nodes
+tol:            float, optional
+                relative residual at which the solver stops; the default is 1e-8
+maxiter:        int, optional
+                maximum number of iterations; the default is 20000
+Returns:        (N_nodes,) array of the voltage (unit: V)
+"""
+def solvePotential(G, I, boundary, tol=1e-8, maxiter=20000):
+    interior = np.flatnonzero(~boundary)
+    A = G[interior][:, interior]
+    Dinv = 1 / A.diagonal()
+    M = LinearOperator(A.shape, matvec=lambda r: Dinv*r, dtype=float)
+    Vint, info = cg(A, I[interior], rtol=tol, maxiter=maxiter, M=M)
+    if info > 0:
+        print("conjugate gradient did not converge to %g within %d iterations\n" % (tol, info))
+
+    V = np.zeros(len(I))
+    V[interior] = Vint
+    return V
+
+
+"""
+Write x y z V lines under '%' header lines, as COMSOL's export does.
+"""
+def writeVoltProf(X, V, fname="exStimVoltProf.txt"):
+    header = "Model: fdmSolver.py\nDimension: 3\nNodes: %d\nExpressions: 1\nLength unit: um\nx y z V (V)" % (len(X))
+    np.savetxt(fname, np.column_stack((X, V)), fmt="%.17g", header=header, comments="% ")
+
+
+"""
+Master function. Takes the same geometry and conductivity arguments as N2C.convert(), and a list of e_R or
+rotate_deg sweeps the electrode likewise. Each conductivity may also be [longitudinal, transverse] for a medium
+anisotropic along x-axis.
+Input:
+h_min:          int or float, optional
+                grid spacing at the TIME electrode; the default is None, which is half the smaller of e_R and a
+                quarter of substrate_D
+h_max:          int or float, optional
+                largest grid spacing; the default is None, which is simBox_size/30
+growth:         float, optional
+                growth factor of the grid spacing away from the electrode; the default is 1.2
+max_nodes:      int, optional
+                largest number of grid nodes; a larger grid raises a ValueError before anything is allocated, since
+                the solver needs about 1 kB per node; the default is 5e6
+
+The substrate is thin, so it is resolved by the spacing across it only: within the substrate's bounding box (padded
+by substrate_D), the spacing along each axis is capped at half the substrate's thickness measured along that axis.
+Axes lying in the substrate's plane, e.g. x, are not refined beyond the grading around the electrode.
+export_mode:    string, optional
+                "mesh" - export the voltage at every grid node; "points" - export it trilinearly interpolated at the
+                NEURON segment centres of table, which C2N then uses directly; the default is None, which is "points"
+                when a table is given and "mesh" otherwise
+table:          SectionTable, optional
+                snapshot of the NEURON model, required by export_mode="points"
+tol:            float, optional
+                relative residual at which the solver stops; the default is 1e-8
+workdir:        string, optional
+                directory the voltage profiles are written to; the default is "."
+Returns:        list of configurations (e_R, rotate_deg, volt_file); a single configuration is exported to
+                exStimVoltProf.txt, a sweep to exStimVoltProf_<i>.txt
+"""
+def convert(simBox_3D, simBox_size, nerve_3D, nerve_R, nerve_L, fasc_3D, fasc_R, fasc_L, \
+                                substrate_3D, substrate_W, substrate_L, substrate_D, e_R, \
+                                e_type="monopolar", e2e_dist=None, rotate_deg=0, simBox_G=1.45, nerve_G=0.01, fasc_G=0.0517, \
+                                h_min=None, h_max=None, growth=1.2, max_nodes=5e6, export_mode=None, table=None, tol=1e-8, \
+                                workdir="."):
+    if export_mode is None:
+        export_mode = "points" if table is not None else "mesh"
+    if export_mode not in ("mesh", "points"):
+        raise ValueError("Incorrect export mode. Mode should be mesh or points. Current mode is: %s" % (export_mode))
+    if export_mode == "points" and table is None:
+        raise ValueError("export_mode points requires a SectionTable")
+
+    configs = N2C.getConfigs(e_R, rotate_deg)
+    for i, config in enumerate(configs, 1):
+        config['volt_file'] = N2C.sweepFileName("exStimVoltProf.txt", i, len(configs))
+        print("finite-difference solution %d of %d: e_R = %g, rotate_deg = %g\n" % (i, len(configs), config['e_R'], config['rotate_deg']))
+
+        # grid around the stimulating contact's face
+        pos, I, normal = getContacts(substrate_3D, substrate_D, config['e_R'], e_type, e2e_dist, config['rotate_deg'])
+        dx_min = h_min if h_min is not None else min(config['e_R'], substrate_D/4) / 2
+        dx_max = h_max if h_max is not None else simBox_size/30
+        box_lo, box_hi = getSubstrateBox(substrate_3D, substrate_W, substrate_L, substrate_D, config['rotate_deg'], \
+                                substrate_D)
+        axes = []
+        for d in range(3):
+            dx_box = substrate_D / (2*abs(normal[d])) if abs(normal[d]) > 1e-6 else dx_max
+            axes.append(gradedAxis(simBox_3D[d] - simBox_size/2, simBox_3D[d] + simBox_size/2, pos[0][d], dx_min, \
+                                dx_max, growth, (box_lo[d], box_hi[d]), max(min(dx_box, dx_max), dx_min)))
+        Nnodes = np.prod([len(a) for a in axes])
+        print("%d x %d x %d grid nodes\n" % tuple(len(a) for a in axes))
+        if Nnodes > max_nodes:
+            raise ValueError("The finite-difference grid has %d nodes, more than max_nodes = %d. Increase h_min, h_max " \
+                    "or growth, or raise max_nodes if the machine has about %.0f GB of memory to spare." \
+                    % (Nnodes, max_nodes, Nnodes*1e3/2**30))
+        X = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+
+        sigma, contacts = voxelise(X, nerve_3D, nerve_R, nerve_L, fasc_3D, fasc_R, fasc_L, substrate_3D, substrate_W, \
+                                substrate_L, substrate_D, config['e_R'], e_type, e2e_dist, config['rotate_deg'], \
+                                simBox_G, nerve_G, fasc_G)
+
+        # 1 uA stimulating current spread over each contact's nodes, as the COMSOL floating potentials inject
+        Inode = np.zeros(len(X))
+        for nodes, current in contacts:
+            Inode[nodes] += current*1e-6 / len(nodes)
+        boundary = np.zeros([len(a) for a in axes], dtype=bool)
+        boundary[[0, -1], :, :] = boundary[:, [0, -1], :] = boundary[:, :, [0, -1]] = True
+        V = solvePotential(assemble(axes, sigma), Inode, boundary.ravel(), tol)
+
+        if export_mode == "points":
+            interp = RegularGridInterpolator(axes, V.reshape(boundary.shape), bounds_error=False, fill_value=0)
+            writeVoltProf(table.segCoords, interp(table.segCoords), os.path.join(workdir, config['volt_file']))
+        else:
+            writeVoltProf(X, V, os.path.join(workdir, config['volt_file']))
+
+    return configs
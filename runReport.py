@@ -0,0 +1,83 @@
+'''
+This file is automatically run by the toolkit. Or, it can be seperately run by users.
+
+It records where the time of a pipeline run goes: the duration of each Python stage, the timings logged by the
+generated MATLAB script (NEURON2COMSOL_timings.json), the size of the NEURON model, of the COMSOL mesh and of the
+files written, all combined into one JSON run report.
+'''
+
+import os
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+
+"""
+Timings and sizes of one pipeline run.
+"""
+class RunReport:
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = []
+        self.files = {}
+        self.info = {}
+
+    """
+    Time the enclosed block as a stage; a stage run several times (e.g. once per electrode configuration) is recorded
+    each time.
+        with report.stage("c2n/interpolate"):
+            ...
+    """
+    @contextmanager
+    def stage(self, name, **info):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append(dict(stage=name, seconds=time.perf_counter() - t0, **info))
+
+    """
+    Record values of the run, e.g. the number of sections and segments.
+    """
+    def add(self, **info):
+        self.info.update(info)
+
+    """
+    Record the size in bytes of the given files that exist.
+    """
+    def addFiles(self, fnames):
+        for fname in fnames:
+            if os.path.exists(fname):
+                self.files[fname] = os.path.getsize(fname)
+
+    """
+    Merge the timings and mesh element counts logged by the generated MATLAB script, if it wrote them.
+    """
+    def addMatlab(self, fname="NEURON2COMSOL_timings.json"):
+        if os.path.exists(fname):
+            with open(fname) as f:
+                self.info['matlab'] = json.load(f)
+            self.addFiles([fname])
+
+    """
+    Total time of each stage over all its runs.
+    """
+    def totals(self):
+        totals = {}
+        for s in self.stages:
+            totals[s['stage']] = totals.get(s['stage'], 0) + s['seconds']
+        return totals
+
+    def save(self, fname="run_report.json"):
+        report = dict(self.info, total_seconds=time.perf_counter() - self.start, stage_totals=self.totals(), \
+                stages=self.stages, files=self.files)
+        with open(fname, 'w') as f:
+            json.dump(report, f, indent=1)
+
+
+"""
+report.stage(name), or a context doing nothing when report is None; lets functions take an optional report.
+"""
+def stage(report, name, **info):
+    return report.stage(name, **info) if report is not None else nullcontext()
@@ -1,6 +1,7 @@
 from neuron import h
 import numpy as np
 from stimStrat import KFS
+import COMSOL2NEURON_auto_conv as C2N
 
 # load NEURON GUI
 h.load_file("nrngui.hoc")
@@ -42,7 +43,7 @@ tk.pipeline(path2server, path2mph, simBox_3D, simBox_size, nerve_3D, nerve_R, ne
 """
 
 # set transfer resistances between the fibres and the electrode
-h.load_file("setrx.hoc")
+C2N.loadrx("rx_xtra_interpolated.txt")
 
 # attach electrode
 h.load_file("attachStim.hoc")
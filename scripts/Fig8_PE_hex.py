@@ -4,6 +4,7 @@ import math
 from scipy.signal import butter, lfilter
 import sys
 from stimStrat import KFS
+import COMSOL2NEURON_auto_conv as C2N
 
 # count the number of spikes given a spike train
 def firingRate(spikeTrain):
@@ -81,7 +82,7 @@ tk.pipeline(path2server, path2mph, simBox_3D, simBox_size, nerve_3D, nerve_R, ne
 """
 
 # set transfer resistances between the fibres and the electrode
-h.load_file("setrx.hoc")
+C2N.loadrx("rx_xtra_interpolated.txt")
 
 # attach electrode
 h.load_file("attachStim.hoc")
@@ -1,5 +1,63 @@
-from math import sin, pi
+import numpy as np
+from numpy import sin, pi
+from collections import OrderedDict
 from neuron import h
+import stimWaveform as sw
+
+'''
+Least recently used cache of unit-amplitude waveform templates, bounded in bytes. Since xtra's is_xtra is linear in
+the stimulus amplitude, a waveform's shape only depends on its timing parameters and dt: an amplitude sweep builds the
+template once and scales it for every amplitude.
+Input:
+max_bytes:  size of the templates kept; least recently used ones are evicted beyond it; the default is 64 MB
+'''
+class WaveformCache:
+
+    def __init__(self, max_bytes=64 << 20):
+        self.max_bytes = max_bytes
+        self.templates = OrderedDict()
+        self.nbytes = 0
+
+    '''
+    Template stored under key, built by build() on a miss. A template is a tuple of read-only arrays: the time points,
+    then one unit-amplitude component per amplitude parameter.
+    '''
+    def get(self, key, build):
+        if key in self.templates:
+            self.templates.move_to_end(key)
+            return self.templates[key]
+
+        template = build()
+        for a in template:
+            a.setflags(write=False)
+        size = sum(a.nbytes for a in template)
+        if size <= self.max_bytes:
+            self.templates[key] = template
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, old = self.templates.popitem(last=False)
+                self.nbytes -= sum(a.nbytes for a in old)
+        return template
+
+    def clear(self):
+        self.templates.clear()
+        self.nbytes = 0
+
+
+# templates shared by all waveforms of this module
+waveforms = WaveformCache()
+
+'''
+Copy a waveform into the hoc Vectors stim_time and stim_amp, played by attachStim.hoc, in one bulk copy each. The
+Vectors are filled in place, so a play() already attached to them keeps working.
+Input:
+t:          array of time points
+amp:        array of stimulus values at the time points
+'''
+def fillStim(t, amp):
+    h.stim_time.from_python(t)
+    h.stim_amp.from_python(amp)
+    return (h.stim_time, h.stim_amp)
 
 '''
 Waveform for kilohertz stimulation
@@ -10,28 +68,24 @@ freq:       frequency of KFS
 dur:        duration of KFS
 last:       duration of silence
 dt:         time resolution
+tol:        if given, fill only the breakpoints of the waveform, its sine sampled within tol (see stimWaveform)
+            instead of every dt; the default is None
 '''
-def KFS(delay, amp, freq, dur, last, dt):
-    N = int((delay+dur+last) / dt) + 1  # +1 in length to avoid vm hyp issue
-    h.stim_amp.resize(N)  
-    h.stim_amp.fill(0)
-    h.stim_time.resize(N)
-    h.stim_time.fill(0)
-
-    # stim time
-    for i in range(0, N):
-        h.stim_time[i] = i*(delay+dur+last) / N
-
-    # stim values
-    for i in range(0, N):
-        if h.stim_time[i] < delay:
-            h.stim_amp[i] = 0	
-        elif h.stim_time[i] < delay+dur:
-            h.stim_amp[i] = amp*sin(2*pi*freq*(h.stim_time[i]-delay-dur)/1000)
-        else:
-            h.stim_amp[i] = 0
+def KFS(delay, amp, freq, dur, last, dt, tol=None):
+    if tol is not None:
+        return fillStim(*sw.sequence(sw.silence(delay), sw.sine(dur, amp, freq, t_zero=dur), sw.silence(last)).breakpoints(tol))
 
-    return (h.stim_time, h.stim_amp)
+    def build():
+        N = int((delay+dur+last) / dt) + 1  # +1 in length to avoid vm hyp issue
+
+        # stim time
+        t = np.arange(N)*(delay+dur+last) / N
+
+        # stim values at unit amplitude
+        return (t, np.select([t < delay, t < delay+dur], [0, sin(2*pi*freq*(t-delay-dur)/1000)], 0))
+
+    t, sine = waveforms.get(('KFS', delay, freq, dur, last, dt), build)
+    return fillStim(t, amp*sine)
 
 '''
 Waveform for cathodic ramp combined with kilohertz stimulation
@@ -47,36 +101,40 @@ fall:       ramp time of anodic KFS ramp
 sineLast:   duration of KFS at zero DC offset
 last:       duration of silence
 dt:         time resolution
+tol:        as in KFS
 '''
-def rampKFS(delay, amp, rise, platDur, sineAmp, freq, sineDur, fall, sineLast, last, dt):
-    N = int((delay+rise+platDur+sineDur+fall+sineLast+last) / dt) + 1  # +1 in length to avoid vm hyp issue
-    h.stim_amp.resize(N)  
-    h.stim_amp.fill(0)
-    h.stim_time.resize(N)
-    h.stim_time.fill(0)
-
-    # stim time
-    for i in range(0, N):
-        h.stim_time[i] = i*(delay+rise+platDur+sineDur+fall+sineLast+last) / N
-
-    # stim values
-    for i in range(0, N):
-        if h.stim_time[i] < delay:
-            h.stim_amp[i] = 0	
-        elif h.stim_time[i] < delay+rise:
-            h.stim_amp[i] = amp*(h.stim_time[i]-delay)/rise
-        elif h.stim_time[i] < delay+rise+platDur:
-            h.stim_amp[i] = amp      
-        elif h.stim_time[i] < delay+rise+platDur+sineDur:
-            h.stim_amp[i] = amp + sineAmp * sin(2*pi*freq*(h.stim_time[i]-delay-rise-platDur)/1000)
-        elif h.stim_time[i] < delay+rise+platDur+sineDur+fall:
-            h.stim_amp[i] = amp - amp*(h.stim_time[i]-delay-rise-platDur-sineDur)/fall + sineAmp * sin(2*pi*freq*(h.stim_time[i]-delay-rise-platDur-sineDur)/1000)
-        elif h.stim_time[i] < delay+rise+platDur+sineDur+fall+sineLast:
-            h.stim_amp[i] = sineAmp * sin(2*pi*freq*(h.stim_time[i]-delay-rise-platDur-sineDur-fall)/1000)
-        else:
-            h.stim_amp[i] = 0
+def rampKFS(delay, amp, rise, platDur, sineAmp, freq, sineDur, fall, sineLast, last, dt, tol=None):
+    if tol is not None:
+        return fillStim(*sw.sequence(sw.silence(delay),
+                                  sw.ramp(rise, 0, amp),
+                                  sw.plateau(platDur, amp),
+                                  sw.plateau(sineDur, amp) + sw.sine(sineDur, sineAmp, freq),
+                                  sw.ramp(fall, amp, 0) + sw.sine(fall, sineAmp, freq),
+                                  sw.sine(sineLast, sineAmp, freq),
+                                  sw.silence(last)).breakpoints(tol))
 
-    return (h.stim_time, h.stim_amp)
+    def build():
+        N = int((delay+rise+platDur+sineDur+fall+sineLast+last) / dt) + 1  # +1 in length to avoid vm hyp issue
+
+        # stim time
+        t = np.arange(N)*(delay+rise+platDur+sineDur+fall+sineLast+last) / N
+
+        # stim values: the cathodic ramp and the KFS at unit amplitude
+        phases = [t < delay,
+                  t < delay+rise,
+                  t < delay+rise+platDur,
+                  t < delay+rise+platDur+sineDur,
+                  t < delay+rise+platDur+sineDur+fall,
+                  t < delay+rise+platDur+sineDur+fall+sineLast]
+        ramp = np.select(phases, [0, (t-delay)/rise, 1, 1, 1 - (t-delay-rise-platDur-sineDur)/fall, 0], 0)
+        sine = np.select(phases, [0, 0, 0,
+                                  sin(2*pi*freq*(t-delay-rise-platDur)/1000),
+                                  sin(2*pi*freq*(t-delay-rise-platDur-sineDur)/1000),
+                                  sin(2*pi*freq*(t-delay-rise-platDur-sineDur-fall)/1000)], 0)
+        return (t, ramp, sine)
+
+    t, ramp, sine = waveforms.get(('rampKFS', delay, rise, platDur, freq, sineDur, fall, sineLast, last, dt), build)
+    return fillStim(t, amp*ramp + sineAmp*sine)
 
 '''
 Waveform for biphasic stimulation
@@ -87,29 +145,20 @@ width:      pulse width of biphasic waveform
 gap:        gap (interval) between biphasic pulses
 last:       duration of silence
 dt:         time resolution
+tol:        as in KFS; the biphasic waveform has no sine, so any tol gives its exact breakpoints
 '''
-def biphasic(delay, amp, width, gap, last, dt):
-    N = int((delay+2*width+gap+last) / dt) + 1  # +1 in length to avoid vm hyp issue
-    h.stim_amp.resize(N)  
-    h.stim_amp.fill(0)
-    h.stim_time.resize(N)
-    h.stim_time.fill(0)
-
-    # stim time
-    for i in range(0, N):
-        h.stim_time[i] = i*(delay+2*width+gap+last) / N
-
-    # stim values
-    for i in range(0, N):
-        if h.stim_time[i] < delay:
-            h.stim_amp[i] = 0	
-        elif h.stim_time[i] < delay+width:
-            h.stim_amp[i] = -1*amp
-        elif h.stim_time[i] < delay+width+gap:
-            h.stim_amp[i] = 0
-        elif h.stim_time[i] < delay+2*width+gap:
-            h.stim_amp[i] = amp
-        else:
-            h.stim_amp[i] = 0
-
-    return (h.stim_time, h.stim_amp)
\ No newline at end of file
+def biphasic(delay, amp, width, gap, last, dt, tol=None):
+    if tol is not None:
+        return fillStim(*sw.sequence(sw.silence(delay), sw.pulse(width, amp, gap), sw.silence(last)).breakpoints(tol))
+
+    def build():
+        N = int((delay+2*width+gap+last) / dt) + 1  # +1 in length to avoid vm hyp issue
+
+        # stim time
+        t = np.arange(N)*(delay+2*width+gap+last) / N
+
+        # stim values at unit amplitude
+        return (t, np.select([t < delay, t < delay+width, t < delay+width+gap, t < delay+2*width+gap], [0, -1, 0, 1], 0.0))
+
+    t, pulse = waveforms.get(('biphasic', delay, width, gap, last, dt), build)
+    return fillStim(t, amp*pulse)
\ No newline at end of file
@@ -0,0 +1,167 @@
+import numpy as np
+
+'''
+Segment-based stimulus waveforms for the interpolated Vector.play of attachStim.hoc. A waveform is built from segments
+(silence, plateau, ramp, sine, pulse), chained in time with sequence() or then(), overlaid with + and scaled with *:
+    w = sequence(silence(10), ramp(5, 0, amp), plateau(20, amp) + sine(20, sineAmp, 10000), silence(20))
+    t, v = w.breakpoints(tol=1e-3)
+Instead of sampling every dt, breakpoints() returns only the points interpolated play needs: the ends of the linear
+parts, and sine parts sampled finely enough that the linear interpolation stays within tol of the sine. A jump between
+segments is a time repeated with the values before and after it.
+Times are in ms and frequencies in Hz, as in stimStrat.
+'''
+class Waveform:
+
+    '''
+    Input:
+    pieces:     list of (t0, t1, v0, v1, sines): on [t0, t1], the line from v0 to v1 plus the sum of the sines, each
+                (A, w, tz) standing for A*sin(w*(t-tz)); the pieces are in order and do not overlap
+    dur:        duration of the waveform; it is zero outside the pieces
+    '''
+    def __init__(self, pieces, dur):
+        self.pieces = [p for p in pieces if p[1] > p[0]]
+        self.dur = dur
+
+    '''
+    Linear part and sines of the waveform on [t0, t1], which lies within one piece or outside all of them
+    '''
+    def restrict(self, t0, t1):
+        tm = (t0 + t1) / 2
+        for p0, p1, v0, v1, sines in self.pieces:
+            if p0 <= tm <= p1:
+                slope = (v1 - v0) / (p1 - p0)
+                return (v0 + slope*(t0 - p0), v0 + slope*(t1 - p0), sines)
+        return (0, 0, ())
+
+    '''
+    This waveform followed by others
+    '''
+    def then(self, *others):
+        pieces = list(self.pieces)
+        dur = self.dur
+        for w in others:
+            pieces += [(t0 + dur, t1 + dur, v0, v1, tuple((A, om, tz + dur) for A, om, tz in sines)) \
+                    for t0, t1, v0, v1, sines in w.pieces]
+            dur += w.dur
+        return Waveform(pieces, dur)
+
+    '''
+    Sum of two waveforms starting at the same time; the shorter one is zero beyond its duration
+    '''
+    def __add__(self, other):
+        if not isinstance(other, Waveform):
+            return NotImplemented
+        cuts = sorted({0, self.dur, other.dur} | {t for p in self.pieces + other.pieces for t in p[:2]})
+        # drop cuts differing only by rounding, which would make needless breakpoints
+        cuts = [t for i, t in enumerate(cuts) if i == 0 or t - cuts[i-1] > 1e-12 * max(abs(t), 1)]
+
+        pieces = []
+        for t0, t1 in zip(cuts[:-1], cuts[1:]):
+            a0, a1, a_sines = self.restrict(t0, t1)
+            b0, b1, b_sines = other.restrict(t0, t1)
+            pieces.append((t0, t1, a0 + b0, a1 + b1, a_sines + b_sines))
+        return Waveform(pieces, max(self.dur, other.dur))
+
+    def __mul__(self, scale):
+        return Waveform([(t0, t1, scale*v0, scale*v1, tuple((scale*A, om, tz) for A, om, tz in sines)) \
+                for t0, t1, v0, v1, sines in self.pieces], self.dur)
+
+    __rmul__ = __mul__
+
+    '''
+    Breakpoints of the waveform for interpolated play
+    Input:
+    tol:        largest deviation of the linear interpolation from the sine parts; the default is None, which is only
+                valid for waveforms without sines
+    Returns:    arrays of time points and of values, the time points non-decreasing and repeated at jumps
+    '''
+    def breakpoints(self, tol=None):
+        ts, vs = [np.array([0.0])], [np.array([0.0])]
+
+        def silent(t0, t1):
+            if vs[-1][-1] != 0:
+                ts.append(np.array([t0]))
+                vs.append(np.array([0.0]))
+            ts.append(np.array([t1]))
+            vs.append(np.array([0.0]))
+
+        t_end = 0
+        for t0, t1, v0, v1, sines in self.pieces:
+            # the linear interpolation of A*sin(w*t) on a step d deviates from it by at most |A|*(1 - cos(w*d/2));
+            # share tol between the sines of a piece
+            n = 1
+            for A, om, tz in sines:
+                if tol is None:
+                    raise ValueError("A tolerance is needed to sample the sine parts of a waveform.")
+                d = 2*np.arccos(max(1 - tol/len(sines)/abs(A), -1)) / om if A != 0 and om != 0 else np.inf
+                n = max(n, int(np.ceil((t1 - t0) / d)))
+            t = np.linspace(t0, t1, n + 1)
+            v = v0 + (v1 - v0)*(t - t0)/(t1 - t0)
+            for A, om, tz in sines:
+                v = v + A*np.sin(om*(t - tz))
+
+            # silence up to this piece, then the piece, starting with a jump unless its first value continues
+            if t0 > t_end:
+                silent(t_end, t0)
+            if v[0] == vs[-1][-1]:
+                t, v = t[1:], v[1:]
+            ts.append(t)
+            vs.append(v)
+            t_end = t1
+        if self.dur > t_end:
+            silent(t_end, self.dur)
+        t, v = np.concatenate(ts), np.concatenate(vs)
+
+        # drop points lying on the line through their neighbours, e.g. where a plateau follows a plateau
+        if len(t) > 2:
+            inner = (t[:-2] < t[1:-1]) & (t[1:-1] < t[2:]) & \
+                    np.isclose((v[1:-1] - v[:-2])*(t[2:] - t[:-2]), (v[2:] - v[:-2])*(t[1:-1] - t[:-2]), \
+                            rtol=1e-12, atol=0)
+            keep = np.concatenate(([True], ~inner, [True]))
+            t, v = t[keep], v[keep]
+        return (t, v)
+
+
+'''
+Zero for dur
+'''
+def silence(dur):
+    return Waveform([], dur)
+
+'''
+Constant amp for dur
+'''
+def plateau(dur, amp):
+    return Waveform([(0, dur, amp, amp, ())], dur)
+
+'''
+Linear ramp from start to end over dur
+'''
+def ramp(dur, start, end):
+    return Waveform([(0, dur, start, end, ())], dur)
+
+'''
+amp*sin(2*pi*freq*(t-t_zero)/1000) for dur
+Input:
+dur:        duration of the sine
+amp:        amplitude of the sine
+freq:       frequency of the sine (unit: Hz)
+t_zero:     time from the start of the segment at which the phase is zero; the default is 0
+'''
+def sine(dur, amp, freq, t_zero=0):
+    return Waveform([(0, dur, 0, 0, ((amp, 2*np.pi*freq/1000, t_zero),))], dur)
+
+'''
+Rectangular pulse of amp for width or, given a gap, a charge-balanced biphasic pulse: -amp for width, zero for gap,
+then amp for width
+'''
+def pulse(width, amp, gap=None):
+    if gap is None:
+        return plateau(width, amp)
+    return sequence(plateau(width, -amp), silence(gap), plateau(width, amp))
+
+'''
+Segments chained in time
+'''
+def sequence(*segments):
+    return silence(0).then(*segments)
@@ -0,0 +1,131 @@
+'''
+This file is used by the toolkit's NEURON-to-COMSOL and COMSOL-to-NEURON conversions. Or, it can be seperately run
+by users.
+
+It takes a snapshot of the NEURON model's sections in a single pass over h.allsec(), stored in NumPy arrays, so that
+the MATLAB script writer, the interpolation and the transfer resistance store all read the same table instead of
+walking NEURON's sections again. A table can be saved to disk, which lets N2C and C2N run in a separate process
+without a NEURON model loaded.
+'''
+
+import hashlib
+import numpy as np
+
+
+"""
+Array-backed snapshot of the NEURON model's sections, in the order of h.allsec().
+Attributes:
+names:          (N_sections,) str array of section names, str(sec)
+fibres:         (N_sections,) str array of fibre names; a fibre is a template instance, or the tree of a section
+                outside templates
+L:              (N_sections,) float array of section lengths
+diam:           (N_sections,) float array of section diameters
+Ra:             (N_sections,) float array of section axial resistivities
+start:          (N_sections, 3) float array of each section's first 3D point
+nseg:           (N_sections,) int array of the number of segments of each section
+segCoords:      (N_segments, 3) float array of the centre of every segment, in the order visited by
+                "forall { for (x,0) }"
+"""
+class SectionTable:
+
+    __slots__ = ('names', 'fibres', 'L', 'diam', 'Ra', 'start', 'nseg', 'segCoords')
+
+    def __init__(self, names, fibres, L, diam, Ra, start, nseg, segCoords):
+        self.names = np.asarray(names, dtype=str)
+        self.fibres = np.asarray(fibres, dtype=str)
+        self.L = np.asarray(L, dtype=float)
+        self.diam = np.asarray(diam, dtype=float)
+        self.Ra = np.asarray(Ra, dtype=float)
+        self.start = np.asarray(start, dtype=float).reshape(-1, 3)
+        self.nseg = np.asarray(nseg, dtype=np.int64)
+        self.segCoords = np.asarray(segCoords, dtype=float).reshape(-1, 3)
+
+    """
+    Take a snapshot of the currently loaded NEURON model in one pass over h.allsec().
+    Segment centres are found by linear interpolation of each section's pt3d points along their normalised arc
+    length; all sections are interpolated in one vectorized call by offsetting each section's normalised arc length
+    by twice its section index.
+    """
+    @classmethod
+    def capture(cls):
+        from neuron import h
+
+        names = []
+        fibres = []
+        props = []
+        arc = []
+        xyz = []
+        query = []
+        for i, sec in enumerate(h.allsec()):
+            cell = sec.cell()
+            names.append(str(sec))
+            fibres.append(str(cell) if cell is not None else str(h.SectionRef(sec=sec).root))
+            props.append((sec.L, sec.diam, sec.Ra, sec.nseg))
+
+            n3d = int(sec.n3d())
+            secXyz = [(sec.x3d(j), sec.y3d(j), sec.z3d(j)) for j in range(n3d)]
+            if n3d == 1:
+                # a single 3D point spans the whole section, instead of reaching towards the next section's first point
+                secArc = np.array([0.0, 1.0])
+                secXyz = secXyz * 2
+            else:
+                secArc = np.array([sec.arc3d(j) for j in range(n3d)])
+                secArc = secArc / secArc[-1] if secArc[-1] > 0 else np.linspace(0, 1, n3d)
+            arc.append(2*i + secArc)
+            xyz.append(secXyz)
+            query.append(2*i + (np.arange(sec.nseg) + 0.5) / sec.nseg)
+
+        if not names:
+            return cls([], [], [], [], [], np.zeros((0, 3)), [], np.zeros((0, 3)))
+
+        props = np.array(props)
+        start = np.array([p[0] for p in xyz])
+        arc = np.concatenate(arc)
+        xyz = np.concatenate(xyz)
+        query = np.concatenate(query)
+        segCoords = np.empty((len(query), 3))
+        for d in range(3):
+            segCoords[:, d] = np.interp(query, arc, xyz[:, d])
+
+        return cls(names, fibres, props[:, 0], props[:, 1], props[:, 2], start, props[:, 3], segCoords)
+
+    @property
+    def Nsec(self):
+        return len(self.names)
+
+    @property
+    def Nseg(self):
+        return len(self.segCoords)
+
+    """
+    Offset of each section's first segment in segCoords, with the total number of segments appended.
+    """
+    @property
+    def offsets(self):
+        return np.concatenate(([0], np.cumsum(self.nseg)))
+
+    """
+    Section names stripped to alphanumeric characters, as used for COMSOL feature tags.
+    """
+    def comsolNames(self):
+        return [''.join(e for e in name if e.isalnum()) for name in self.names]
+
+    """
+    Hash of the whole table; identical models give identical hashes.
+    """
+    def hash(self):
+        sha = hashlib.sha1()
+        for slot in self.__slots__:
+            a = getattr(self, slot)
+            sha.update(slot.encode())
+            sha.update('\0'.join(a).encode() if a.dtype.kind == 'U' else np.ascontiguousarray(a).tobytes())
+        return sha.hexdigest()
+
+    def save(self, fname="sectionTable.npz"):
+        with open(fname, 'wb') as f:
+            np.savez(f, **{slot: getattr(self, slot) for slot in self.__slots__})
+
+    @classmethod
+    def load(cls, fname="sectionTable.npz"):
+        with np.load(fname) as data:
+            return cls(**{slot: data[slot] for slot in cls.__slots__})